@@ -0,0 +1,187 @@
+"""Local stand-in for the extended lending subgraph, serving synthetic data
+
+Usage:
+    python -m benchmarks.mock_subgraph [--port 8765] [--positions 50000] [--latency-ms 50]
+
+Only the queries issued by utils.py are understood. They are recognised by their
+root fields, not parsed as GraphQL. GET /_stats returns request and byte counters,
+POST /_stats/reset clears them.
+"""
+import argparse
+import asyncio
+import bisect
+import hashlib
+import json
+import random
+import re
+from aiohttp import web
+
+HEAD_BLOCK = 20_000_000
+BLOCKS_PER_DAY = 43_200
+DAY_SECONDS = 86_400
+HEAD_TIMESTAMP = 1_660_000_000
+MARKET_COUNT = 12
+EVENT_COLLECTIONS = ("deposits", "borrows", "withdraws", "repays", "liquidates")
+
+
+class SyntheticSubgraph:
+    """Deterministic accounts, positions, markets and events at a given scale
+
+    WHALE_ID is an account with positions in every market and events_per_type events
+    of every type, which the benchmarks use for the per account queries.
+    """
+
+    WHALE_ID = "0x" + "7" * 40
+
+    def __init__(self, positions: int, events_per_type: int = 2500, seed: int = 7):
+        rng = random.Random(seed)
+        self.markets = []
+        for i in range(MARKET_COUNT):
+            decimals = rng.choice([6, 8, 18])
+            self.markets.append({
+                "market_id": "0x" + hashlib.sha1(f"market{i}".encode()).hexdigest(),
+                "inputTokenPriceUSD": str(round(rng.uniform(0.5, 30000), 6)),
+                "inputToken": {"symbol": f"TKN{i}", "decimals": decimals},
+                "rates": [
+                    {"rate": str(round(rng.uniform(0, 10), 4)), "rate_side": "LENDER", "rate_type": "VARIABLE"},
+                    {"rate": str(round(rng.uniform(0, 15), 4)), "rate_side": "BORROWER", "rate_type": "VARIABLE"},
+                    {"rate": str(round(rng.uniform(0, 20), 4)), "rate_side": "BORROWER", "rate_type": "STABLE"},
+                ],
+                "dailySnapshots": [{
+                    "totalBorrowBalanceUSD": str(round(rng.uniform(1e6, 1e9), 2)),
+                    "totalDepositBalanceUSD": str(round(rng.uniform(1e7, 1e10), 2)),
+                }],
+            })
+
+        accounts = {}
+        for _ in range(positions):
+            account_id = "0x" + "%040x" % rng.getrandbits(160)
+            market = rng.choice(self.markets)
+            balance = str(rng.getrandbits(rng.randint(20, 100)))
+            side = rng.choice(["LENDER", "BORROWER"])
+            account_positions = accounts.setdefault(account_id, [])
+            account_positions.append({
+                "position_id": f"{account_id}-{market['market_id']}-{side}-{len(account_positions)}",
+                "balance": balance, "side": side, "market": {"market_id": market["market_id"]}})
+        accounts[self.WHALE_ID] = [
+            {"position_id": f"{self.WHALE_ID}-{market['market_id']}-{side}-0",
+             "balance": str(10 ** (market["inputToken"]["decimals"] + 6)), "side": side, "market": {"market_id": market["market_id"]}}
+            for market in self.markets for side in ("LENDER", "BORROWER")
+        ]
+        self.account_ids = sorted(accounts)
+        self.accounts = [{"account_id": account_id, "positions": accounts[account_id]} for account_id in self.account_ids]
+
+        self.events = {}
+        for collection in EVENT_COLLECTIONS:
+            events = []
+            for i in range(events_per_type):
+                market = self.markets[i % MARKET_COUNT]
+                events.append({
+                    "id": f"0x{collection}{i:08d}",
+                    "amount": str(rng.getrandbits(70)),
+                    "amountUSD": str(round(rng.uniform(1, 1e6), 2)),
+                    "asset": {"symbol": market["inputToken"]["symbol"], "decimals": market["inputToken"]["decimals"]},
+                    # several events per timestamp so cursor ties are exercised
+                    "timestamp": str(HEAD_TIMESTAMP - (events_per_type - i) // 3 * 60),
+                })
+            self.events[collection] = events
+
+    def _market_fields(self, market_id: str) -> dict:
+        market = next(m for m in self.markets if m["market_id"] == market_id)
+        return {"market_id": market_id, "inputTokenPriceUSD": market["inputTokenPriceUSD"], "inputToken": market["inputToken"]}
+
+    def resolve(self, query: str, variables: dict) -> dict:
+        if "_meta" in query:
+            return {"_meta": {"block": {"number": HEAD_BLOCK}}}
+        if "financialsDailySnapshots" in query:
+            return {"financialsDailySnapshots": [
+                {"blockNumber": str(HEAD_BLOCK - day * BLOCKS_PER_DAY), "timestamp": str(HEAD_TIMESTAMP - day * DAY_SECONDS)}
+                for day in range(variables["days_back"])
+            ]}
+        if "markets(" in query:
+            return {"markets": self.markets}
+        if re.search(r"\bb\d+: accounts", query):
+            return self._accounts_at_blocks(query, variables)
+        if "accounts(" in query:
+            return {"accounts": self._accounts_page(variables)}
+        if "positions(" in query:
+            # nothing changes between blocks in the synthetic data
+            return {"positions": []}
+        if "events:" in query:
+            return {"events": self._events_page(query, variables)}
+        raise ValueError(f"unsupported query: {query[:200]}")
+
+    def _accounts_page(self, variables: dict) -> list:
+        start = bisect.bisect_right(self.account_ids, variables["last_id"])
+        stop = bisect.bisect_left(self.account_ids, variables["upper_id"]) if "upper_id" in variables else len(self.account_ids)
+        return self.accounts[start:min(stop, start + variables["first"])]
+
+    def _accounts_at_blocks(self, query: str, variables: dict) -> dict:
+        result = []
+        for account_id in sorted(set(variables["account_ids"])):
+            index = bisect.bisect_left(self.account_ids, account_id)
+            if index < len(self.account_ids) and self.account_ids[index] == account_id:
+                account = self.accounts[index]
+                result.append({
+                    "account_id": account["account_id"],
+                    "positions": [dict(position, market=self._market_fields(position["market"]["market_id"])) for position in account["positions"]],
+                })
+        return {f"b{block}": result for block in re.findall(r"\bb(\d+): accounts", query)}
+
+    def _events_page(self, query: str, variables: dict) -> list:
+        collection = re.search(r"events: (\w+)\(", query).group(1)
+        if variables["account_id"] != self.WHALE_ID:
+            return []
+        seen_ids = set(variables["seen_ids"])
+        timestamp = int(variables["timestamp"])
+        page = []
+        for event in self.events[collection]:
+            if int(event["timestamp"]) >= timestamp and event["id"] not in seen_ids:
+                page.append(event)
+                if len(page) == variables["first"]:
+                    break
+        return page
+
+
+def create_app(subgraph: SyntheticSubgraph, latency_ms: float = 0) -> web.Application:
+    stats = {"requests": 0, "request_bytes": 0, "response_bytes": 0}
+
+    async def graphql(request: web.Request) -> web.Response:
+        body = await request.read()
+        payload = json.loads(body)
+        if latency_ms:
+            await asyncio.sleep(latency_ms / 1000)
+        response_body = json.dumps({"data": subgraph.resolve(payload["query"], payload.get("variables") or {})}).encode()
+        stats["requests"] += 1
+        stats["request_bytes"] += len(body)
+        stats["response_bytes"] += len(response_body)
+        return web.Response(body=response_body, content_type="application/json")
+
+    async def get_stats(request: web.Request) -> web.Response:
+        return web.json_response(stats)
+
+    async def reset_stats(request: web.Request) -> web.Response:
+        for key in stats:
+            stats[key] = 0
+        return web.json_response(stats)
+
+    app = web.Application(client_max_size=16 * 1024 ** 2)
+    app.router.add_post("/", graphql)
+    app.router.add_get("/_stats", get_stats)
+    app.router.add_post("/_stats/reset", reset_stats)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve synthetic extended lending subgraph data")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--positions", type=int, default=50_000)
+    parser.add_argument("--events-per-type", type=int, default=2500)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    args = parser.parse_args()
+    subgraph = SyntheticSubgraph(args.positions, events_per_type=args.events_per_type)
+    web.run_app(create_app(subgraph, args.latency_ms), host="127.0.0.1", port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,302 @@
+"""End to end benchmarks of the data layer against the local mock subgraph
+
+Usage:
+    python -m benchmarks.run_benchmarks [--positions 50000] [--latency-ms 20]
+        [--save-baseline bench_baseline.json] [--baseline bench_baseline.json] [--tolerance 2.0]
+
+Reports wall time, request count, bytes transferred and peak Python memory per
+benchmark. With --baseline, the run uses the scale the baseline was saved at and
+exits with status 1 if any metric exceeds the baseline by more than --tolerance
+times (10% for request and byte counts).
+
+A reference baseline is committed, --baseline without a path checks against it:
+    python -m benchmarks.run_benchmarks --baseline
+It holds no timings, they depend on the machine, so it only checks request counts,
+bytes and peak memory. Timings are checked against a baseline saved on the same machine.
+
+Every run also checks results: the partitioned scan must equal the sequential one, the
+account events must be complete, and the leaderboard queries and the snapshot diff must
+agree with naive pandas versions. A mismatch raises AssertionError.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+import urllib.request
+import numpy as np
+import pandas as pd
+import snapshot_diff
+import snapshot_index
+import subgraph
+import utils
+from benchmarks.mock_subgraph import SyntheticSubgraph
+
+STARTUP_TIMEOUT_SECONDS = 120
+REFERENCE_BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+# mock subgraph arguments saved with a baseline
+SCALE_ARGS = ("positions", "events_per_type", "latency_ms")
+# requests and bytes are deterministic for a given scale, only timings and memory need slack
+COUNT_TOLERANCE = 1.1
+# small absolute values are all noise, metrics are compared against at least these
+METRIC_FLOORS = {"seconds": 0.05, "requests": 1, "bytes": 1024, "peak_mb": 1}
+# left out of the committed reference baseline
+MACHINE_METRICS = ("seconds",)
+
+
+def _stats_request(url: str, path: str, method: str = "GET") -> dict:
+    request = urllib.request.Request(url.rstrip("/") + path, method=method)
+    with urllib.request.urlopen(request) as resp:
+        return json.load(resp)
+
+
+def start_mock_subgraph(port: int, positions: int, events_per_type: int, latency_ms: float) -> subprocess.Popen:
+    """Runs the mock subgraph in its own process so it doesn't skew timings or memory"""
+    process = subprocess.Popen([
+        sys.executable, "-m", "benchmarks.mock_subgraph", "--port", str(port), "--positions", str(positions),
+        "--events-per-type", str(events_per_type), "--latency-ms", str(latency_ms),
+    ])
+    url = f"http://127.0.0.1:{port}/"
+    deadline = time.time() + STARTUP_TIMEOUT_SECONDS
+    while True:
+        try:
+            _stats_request(url, "/_stats")
+            return process
+        except OSError:
+            if process.poll() is not None or time.time() > deadline:
+                process.kill()
+                raise RuntimeError("mock subgraph did not start")
+            time.sleep(0.2)
+
+
+def measure(url: str, name: str, fn) -> tuple:
+    """Runs fn once with cold client caches and returns (result, metrics dict)"""
+    utils._account_block_cache.clear()
+    utils._account_events_cache.clear()
+    _stats_request(url, "/_stats/reset", "POST")
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = fn()
+    seconds = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    stats = _stats_request(url, "/_stats")
+    return result, {
+        "name": name,
+        "seconds": seconds,
+        "requests": stats["requests"],
+        "bytes": stats["request_bytes"] + stats["response_bytes"],
+        "peak_mb": peak / 1024 ** 2,
+    }
+
+
+def naive_leaderboard(open_positions_df: pd.DataFrame, side: str, sort_by: str = "usd_value", descending: bool = True,
+                      min_usd_value: float = None, address_prefix: str = None, start: int = 0, stop: int = None) -> tuple:
+    """snapshot_index.query_leaderboard with a groupby and sorts over the full snapshot"""
+    side_df = open_positions_df[open_positions_df["side"] == side]
+    # groupby orders accounts by address, so usd_value ties stay in address order
+    board = side_df.groupby("account_id").agg(usd_value=("balance_usd", "sum"), asset_count=("balance_usd", "size")).reset_index()
+    board = board.sort_values("usd_value", ascending=False, kind="stable")
+    if sort_by != "usd_value":
+        board = board.sort_values(sort_by, ascending=False, kind="stable")
+    if min_usd_value is not None:
+        board = board[board["usd_value"] >= min_usd_value]
+    if address_prefix:
+        board = board[board["account_id"].str.startswith("0x" + address_prefix.lower().removeprefix("0x"))]
+    if not descending:
+        board = board.iloc[::-1]
+    return len(board), board.iloc[start:stop].reset_index(drop=True)
+
+
+def naive_diff(before_df: pd.DataFrame, after_df: pd.DataFrame) -> dict:
+    """snapshot_diff.diff_snapshots with an outer join of the grouped snapshots"""
+    keys = ["account_id", "market.market_id", "side"]
+
+    def grouped(df):
+        return df.groupby(keys).agg(
+            balance=("balance_adj", "sum"), price=("market.inputTokenPriceUSD", "first"), symbol=("market.inputToken.symbol", "first"))
+
+    merged = grouped(before_df).join(grouped(after_df), how="outer", lsuffix="_before", rsuffix="_after").reset_index()
+    balance_before = merged["balance_before"].fillna(0.0)
+    balance_after = merged["balance_after"].fillna(0.0)
+    merged = merged[balance_before != balance_after]
+    balance_before, balance_after = balance_before[merged.index], balance_after[merged.index]
+    status = np.where(merged["balance_before"].isna(), snapshot_diff.OPENED,
+                      np.where(merged["balance_after"].isna(), snapshot_diff.CLOSED, snapshot_diff.CHANGED))
+    positions_df = pd.DataFrame({
+        "account_id": merged["account_id"],
+        "side": merged["side"],
+        "market.market_id": merged["market.market_id"],
+        "market.inputToken.symbol": merged["symbol_after"].fillna(merged["symbol_before"]),
+        "status": status,
+        "balance_adj_before": balance_before,
+        "balance_adj": balance_after,
+        "change_usd": (balance_after - balance_before) * merged["price_after"].fillna(merged["price_before"]),
+    }).reset_index(drop=True)
+
+    moved = sorted(positions_df["account_id"].unique())
+    after_usd = after_df["balance_adj"] * after_df["market.inputTokenPriceUSD"]
+    is_lender = positions_df["side"] == "LENDER"
+
+    def per_account(values, mask, by):
+        return values[mask].groupby(by[mask]).sum().reindex(moved, fill_value=0).to_numpy()
+
+    accounts_df = pd.DataFrame({
+        "account_id": moved,
+        "deposits_usd": per_account(after_usd, after_df["side"] == "LENDER", after_df["account_id"]),
+        "deposits_change_usd": per_account(positions_df["change_usd"], is_lender, positions_df["account_id"]),
+        "borrows_usd": per_account(after_usd, after_df["side"] == "BORROWER", after_df["account_id"]),
+        "borrows_change_usd": per_account(positions_df["change_usd"], ~is_lender, positions_df["account_id"]),
+        "opened": per_account(pd.Series(1, index=positions_df.index), positions_df["status"] == snapshot_diff.OPENED, positions_df["account_id"]),
+        "closed": per_account(pd.Series(1, index=positions_df.index), positions_df["status"] == snapshot_diff.CLOSED, positions_df["account_id"]),
+    })
+    return {"accounts": accounts_df, "positions": positions_df}
+
+
+def _assert_same_rows(df: pd.DataFrame, expected_df: pd.DataFrame, by: list):
+    """Compares two frames ignoring row order and integer widths"""
+    pd.testing.assert_frame_equal(
+        df.sort_values(by, ignore_index=True), expected_df[list(df.columns)].sort_values(by, ignore_index=True), check_dtype=False)
+
+
+def _moved_snapshot(open_positions_df: pd.DataFrame) -> pd.DataFrame:
+    """A later snapshot with closed, changed and opened positions and one repriced market"""
+    rows = np.arange(len(open_positions_df))
+    after_df = open_positions_df[rows % 7 != 0].reset_index(drop=True)
+    changed = after_df.index[::5]
+    after_df.loc[changed, "balance_adj"] = after_df.loc[changed, "balance_adj"] * 1.5
+    repriced = after_df["market.market_id"] == after_df["market.market_id"].iloc[0]
+    after_df.loc[repriced, "market.inputTokenPriceUSD"] = after_df.loc[repriced, "market.inputTokenPriceUSD"] * 2
+    opened_df = open_positions_df.iloc[:100].assign(account_id=[f"0x{i:040x}" for i in range(100)])
+    return pd.concat([after_df, opened_df]).sort_values("account_id", kind="stable", ignore_index=True)
+
+
+def check_results(sequential_df: pd.DataFrame, partitioned_df: pd.DataFrame, index: dict, events_df: pd.DataFrame, events_per_type: int):
+    """Checks the benchmarked results against the sequential scan and naive pandas versions"""
+    pd.testing.assert_frame_equal(sequential_df, partitioned_df)
+    # the mock answers every event type for the whale, with several events per cursor timestamp
+    event_counts = events_df["event"].value_counts().to_dict()
+    assert event_counts == dict.fromkeys(utils.ACCOUNT_EVENT_TYPES, events_per_type), f"account events per type: {event_counts}"
+
+    queries = [
+        {"side": "LENDER"},
+        {"side": "BORROWER", "start": 50, "stop": 150},
+        {"side": "LENDER", "sort_by": "asset_count", "min_usd_value": 1.0, "address_prefix": "0xa", "start": 100, "stop": 200},
+        {"side": "BORROWER", "sort_by": "account_id", "descending": False, "start": 10, "stop": 60},
+        {"side": "LENDER", "sort_by": "asset_count", "descending": False, "min_usd_value": 1000.0, "stop": 100},
+        {"side": "BORROWER", "address_prefix": "0X3F", "stop": 100},
+    ]
+    for query in queries:
+        total, page_df = snapshot_index.query_leaderboard(index, **query)
+        expected_total, expected_df = naive_leaderboard(sequential_df, **query)
+        assert total == expected_total, f"{query}: {total} accounts, expected {expected_total}"
+        pd.testing.assert_frame_equal(page_df, expected_df, check_dtype=False)
+
+    after_df = _moved_snapshot(sequential_df)
+    diff = snapshot_diff.diff_snapshots(sequential_df, after_df)
+    expected = naive_diff(sequential_df, after_df)
+    _assert_same_rows(diff["positions"], expected["positions"], ["account_id", "market.market_id", "side"])
+    _assert_same_rows(diff["accounts"], expected["accounts"], ["account_id"])
+
+
+def run_benchmarks(url: str, events_per_type: int) -> list:
+    block = utils.get_lastest_synced_block_number(url)
+    account_id = SyntheticSubgraph.WHALE_ID
+    results = []
+
+    sequential_df, metrics = measure(url, "open_positions_sequential", lambda: utils.get_all_open_positions(url, block))
+    results.append(metrics)
+    open_positions_df, metrics = measure(url, "open_positions_partitioned", lambda: utils.get_all_open_positions(url, block, partitions=16))
+    results.append(metrics)
+    _, metrics = measure(url, "account_daily_positions_30d", lambda: utils.get_account_daily_positions(url, account_id, 30))
+    results.append(metrics)
+    events_df, metrics = measure(url, "account_events", lambda: utils.get_account_events(url, account_id))
+    results.append(metrics)
+    index, metrics = measure(url, "leaderboard_index", lambda: snapshot_index.build_snapshot_index(open_positions_df))
+    results.append(metrics)
+    _, metrics = measure(url, "leaderboard_page_query", lambda: snapshot_index.query_leaderboard(
+        index, "LENDER", sort_by="asset_count", min_usd_value=1.0, address_prefix="0xa", start=100, stop=200))
+    results.append(metrics)
+    top_accounts = snapshot_index.get_leaderboard(index, "LENDER", stop=100)["account_id"].tolist()
+    _, metrics = measure(url, "leaderboard_history_30d", lambda: utils.get_accounts_daily_positions(url, top_accounts, 31))
+    results.append(metrics)
+
+    check_results(sequential_df, open_positions_df, index, events_df, events_per_type)
+    return results
+
+
+def print_report(results: list):
+    print(f"{'benchmark':<32}{'seconds':>10}{'requests':>10}{'MB sent+recv':>14}{'peak MB':>10}")
+    for metrics in results:
+        print(f"{metrics['name']:<32}{metrics['seconds']:>10.3f}{metrics['requests']:>10}{metrics['bytes'] / 1024 ** 2:>14.2f}{metrics['peak_mb']:>10.1f}")
+
+
+def find_regressions(results: list, baseline: list, tolerance: float) -> list:
+    """Lists 'benchmark metric' entries that grew more than allowed over the baseline
+
+    Metrics missing from the baseline, like timings in the reference baseline, are not compared.
+    """
+    baseline_by_name = {metrics["name"]: metrics for metrics in baseline}
+    regressions = []
+    for metrics in results:
+        reference = baseline_by_name.get(metrics["name"])
+        if reference is None:
+            continue
+        for metric, floor in METRIC_FLOORS.items():
+            if metric not in reference:
+                continue
+            allowed = COUNT_TOLERANCE if metric in ("requests", "bytes") else tolerance
+            if metrics[metric] > max(reference[metric], floor) * allowed:
+                regressions.append(f"{metrics['name']} {metric}: {metrics[metric]:.3f} vs baseline {reference[metric]:.3f}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the data layer against a local mock subgraph")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--positions", type=int, default=50_000)
+    parser.add_argument("--events-per-type", type=int, default=2500)
+    parser.add_argument("--latency-ms", type=float, default=20)
+    parser.add_argument("--save-baseline", help="write results as JSON to this path")
+    parser.add_argument("--baseline", nargs="?", const=REFERENCE_BASELINE,
+                        help="compare against results saved with --save-baseline, defaults to the committed reference")
+    parser.add_argument("--tolerance", type=float, default=2.0, help="allowed growth of seconds and peak MB")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.baseline:
+        if not os.path.exists(args.baseline):
+            parser.error(f"baseline {args.baseline} does not exist, create it with --save-baseline")
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        # counts and bytes only compare at the scale the baseline was taken at
+        for arg in SCALE_ARGS:
+            setattr(args, arg, baseline["scale"][arg])
+
+    process = start_mock_subgraph(args.port, args.positions, args.events_per_type, args.latency_ms)
+    try:
+        results = run_benchmarks(f"http://127.0.0.1:{args.port}/", args.events_per_type)
+    finally:
+        subgraph.close()
+        process.terminate()
+        process.wait()
+
+    print_report(results)
+    if args.save_baseline:
+        saved = results
+        if os.path.abspath(args.save_baseline) == os.path.abspath(REFERENCE_BASELINE):
+            saved = [{key: value for key, value in metrics.items() if key not in MACHINE_METRICS} for metrics in results]
+        with open(args.save_baseline, "w") as f:
+            json.dump({"scale": {arg: getattr(args, arg) for arg in SCALE_ARGS}, "results": saved}, f, indent=2)
+            f.write("\n")
+    if baseline is not None:
+        regressions = find_regressions(results, baseline["results"], args.tolerance)
+        for regression in regressions:
+            print("REGRESSION", regression)
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
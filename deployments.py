@@ -0,0 +1,56 @@
+"""Several lending deployments that share the extended lending subgraph schema
+
+Deployments are configured in the secrets as a table of name to subgraph URL:
+
+    [SUBGRAPHS]
+    "AAVE V2 Avalanche" = "https://api.thegraph.com/subgraphs/name/..."
+    "AAVE V3 Polygon" = "https://api.thegraph.com/subgraphs/name/..."
+
+Without SUBGRAPHS the single AAVE_SUBGRAPH URL is used. Every deployment keeps its own
+snapshots, pinned to its own block, in the snapshot store.
+"""
+import pandas as pd
+import snapshot_store
+
+DEPLOYMENT_COLUMN = "deployment"
+DEFAULT_DEPLOYMENT = "AAVE V2 on Avalanche"
+
+
+def get_deployments(secrets) -> dict:
+    """Reads {deployment name: subgraph URL} from a secrets mapping, e.g. st.secrets or a parsed secrets.toml"""
+    if secrets.get("SUBGRAPHS"):
+        return dict(secrets["SUBGRAPHS"])
+    if secrets.get("AAVE_SUBGRAPH"):
+        return {DEFAULT_DEPLOYMENT: secrets["AAVE_SUBGRAPH"]}
+    return {}
+
+
+def load_latest_snapshots(deployments: dict, newer_than: dict = None) -> dict:
+    """Reads the newest stored open positions snapshot of every deployment
+
+    Args:
+        deployments (dict): {deployment name: subgraph URL}
+        newer_than (dict): {deployment name: block}, deployments with nothing newer are skipped
+            (default is None)
+
+    Returns:
+        dict: {deployment name: (block_num, pd.DataFrame)} for deployments with a snapshot on disk
+    """
+    newer_than = newer_than or {}
+    snapshots = {}
+    for name, subgraph_url in deployments.items():
+        blocks = snapshot_store.list_snapshots(subgraph_url, snapshot_store.OPEN_POSITIONS)
+        if blocks and blocks[-1] > newer_than.get(name, -1):
+            df = snapshot_store.load_snapshot(subgraph_url, snapshot_store.OPEN_POSITIONS, blocks[-1])
+            # None if the block was pruned between listing and reading it
+            if df is not None:
+                snapshots[name] = (blocks[-1], df)
+    return snapshots
+
+
+def merge_snapshots(frames: dict) -> pd.DataFrame:
+    """Concatenates {deployment name: open positions frame} into one frame with a deployment column"""
+    merged = [df.assign(**{DEPLOYMENT_COLUMN: name}) for name, df in frames.items()]
+    if not merged:
+        return pd.DataFrame(columns=[DEPLOYMENT_COLUMN])
+    return pd.concat(merged, ignore_index=True)
@@ -0,0 +1,148 @@
+import contextvars
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+logger = logging.getLogger("whales.metrics")
+
+# events emitted while a collector is bound are also appended to it, e.g. everything
+# that happens during one Streamlit render
+_collector = contextvars.ContextVar("instrumentation_collector", default=None)
+
+_metrics_lock = threading.Lock()
+# (metric name, label name, label value) -> value
+_counters = defaultdict(float)
+
+_METRIC_HELP = {
+    "subgraph_requests_total": "Subgraph requests sent",
+    "subgraph_request_seconds_total": "Time spent in subgraph requests, including retries",
+    "subgraph_response_bytes_total": "Decoded subgraph response bytes",
+    "subgraph_retries_total": "Subgraph request retries",
+    "stage_runs_total": "Data pipeline stage runs",
+    "stage_seconds_total": "Time spent in data pipeline stages",
+    "stage_rows_out_total": "Rows produced by data pipeline stages",
+    "cache_hits_total": "Cache hits",
+    "cache_misses_total": "Cache misses",
+}
+
+
+def start_collecting() -> list:
+    """Binds a new collector to the current context and returns it"""
+    events = []
+    _collector.set(events)
+    return events
+
+
+def current_collector() -> list:
+    return _collector.get()
+
+
+@contextmanager
+def bind_collector(events: list):
+    """Binds an existing collector, used to carry it into another thread or event loop"""
+    token = _collector.set(events)
+    try:
+        yield events
+    finally:
+        _collector.reset(token)
+
+
+def _increment(metric: str, label: str, value: str, amount: float = 1):
+    with _metrics_lock:
+        _counters[(metric, label, value)] += amount
+
+
+def emit(kind: str, name: str, **fields):
+    """Logs one event as JSON and hands it to the bound collector"""
+    event = {"kind": kind, "name": name, "ts": round(time.time(), 3), **fields}
+    logger.info(json.dumps(event, default=str))
+    events = _collector.get()
+    if events is not None:
+        events.append(event)
+
+
+def record_request(operation: str, seconds: float, response_bytes: int, retries: int, ok: bool = True):
+    """Records one subgraph request, operation is the query's first root field"""
+    _increment("subgraph_requests_total", "operation", operation)
+    _increment("subgraph_request_seconds_total", "operation", operation, seconds)
+    _increment("subgraph_response_bytes_total", "operation", operation, response_bytes)
+    _increment("subgraph_retries_total", "operation", operation, retries)
+    emit("request", operation, seconds=round(seconds, 4), bytes=response_bytes, retries=retries, ok=ok)
+
+
+def record_cache(cache: str, hit: bool, count: int = 1):
+    """Records cache lookups, count lets a batch of lookups be recorded at once"""
+    if count == 0:
+        return
+    _increment("cache_hits_total" if hit else "cache_misses_total", "cache", cache, count)
+    emit("cache", cache, hit=hit, count=count)
+
+
+@contextmanager
+def stage(name: str, rows_in: int = None):
+    """Times a data pipeline stage
+
+    Set "rows_out" on the yielded dict to record the stage's output size.
+
+    Example:
+        with instrumentation.stage("open_positions.merge", rows_in=len(positions_df)) as info:
+            df = ...
+            info["rows_out"] = len(df)
+    """
+    info = {}
+    started = time.perf_counter()
+    try:
+        yield info
+    finally:
+        seconds = time.perf_counter() - started
+        _increment("stage_runs_total", "stage", name)
+        _increment("stage_seconds_total", "stage", name, seconds)
+        if info.get("rows_out") is not None:
+            _increment("stage_rows_out_total", "stage", name, info["rows_out"])
+        emit("stage", name, seconds=round(seconds, 4), rows_in=rows_in, rows_out=info.get("rows_out"))
+
+
+def render_prometheus() -> str:
+    """Renders all counters in the Prometheus text exposition format"""
+    with _metrics_lock:
+        counters = dict(_counters)
+    lines = []
+    for metric in sorted({key[0] for key in counters}):
+        lines.append(f"# HELP {metric} {_METRIC_HELP.get(metric, metric)}")
+        lines.append(f"# TYPE {metric} counter")
+        for (name, label, value), amount in sorted(counters.items()):
+            if name == metric:
+                lines.append(f'{metric}{{{label}="{value}"}} {amount:g}')
+    return "\n".join(lines) + "\n"
+
+
+def enable_logging():
+    """Logs every event as a JSON line on stderr, calling it again (e.g. on every Streamlit rerun) does nothing"""
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(handler)
+        # the host's root handlers would print every event a second time
+        logger.propagate = False
+    logger.setLevel(logging.INFO)
+
+
+def write_prometheus(path: str):
+    """Atomically replaces path with the current counters, for node_exporter's textfile collector"""
+    # a unique temporary name, every session thread of the app writes the file after its render
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(render_prometheus())
+        # mkstemp creates the file owner-only, the collector may run as another user
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
@@ -1,134 +1,410 @@
-from pyrsistent import get_in
 import streamlit as st
 import pandas as pd
-import requests
-import plotly.express as px
-from subgrounds.subgrounds import Subgrounds
 import utils
+import instrumentation
+import snapshot_store
+import worker
+import snapshot_index
+import snapshot_diff
+import deployments
+import table_format
 from millify import millify
 from refresh_component import refresh_component
 import datetime
-
-from string import Template
+import hashlib
+import logging
+import threading
+import time
 
 st.set_page_config(page_title="Whale Watcher", page_icon="🐋", layout="wide")
+# refresh failures are logged at error level, so they reach stderr even without a configured handler
+logger = logging.getLogger("whales.app")
+# everything instrumented during this render, shown in the sidebar performance panel
+render_events = instrumentation.start_collecting()
+render_started = time.perf_counter()
+show_performance = st.sidebar.checkbox("Show performance breakdown")
 nav_container = st.container()
-st.title("🐋 Whale Watcher")
-st.text("AAVE V2 on Avalanche")
 
 # using secrets file for general env vars https://docs.streamlit.io/streamlit-cloud/get-started/deploy-an-app/connect-to-data-sources/secrets-management
-url = st.secrets["AAVE_SUBGRAPH"]
+# {deployment name: subgraph URL}, see deployments.py for the SUBGRAPHS table
+deployment_urls = deployments.get_deployments(st.secrets)
+# set when worker.py publishes snapshots, the app then never queries the subgraph for them itself
+external_snapshot_worker = st.secrets.get("EXTERNAL_SNAPSHOT_WORKER", False)
+# LOG_METRICS prints every request, stage and cache event as a JSON line, METRICS_FILE is rewritten
+# with the process's Prometheus counters after every render and snapshot refresh
+if st.secrets.get("LOG_METRICS", False):
+    instrumentation.enable_logging()
+metrics_file = st.secrets.get("METRICS_FILE")
+
+st.title("🐋 Whale Watcher")
+st.text(", ".join(deployment_urls))
+if not deployment_urls:
+    st.error("No subgraph configured, set SUBGRAPHS or AAVE_SUBGRAPH in the secrets.")
+    st.stop()
+
+REFRESH_SECONDS = 300
+LEADERBOARD_PAGE_SIZE = 100
+LEADERBOARD_SORTS = {"Value": "usd_value", "No. of assets": "asset_count", "Address": "account_id"}
+ALL_DEPLOYMENTS = "All deployments"
+MOVERS_COUNT = 100
+MOVER_SORTS = {"Deposit change": "deposits_change_usd", "Borrow change": "borrows_change_usd"}
+
+def build_snapshot(previous, updates):
+    # derived structures are built once here instead of on every rerun, only the compact indexes are
+    # kept so the wide frames can be freed. Deployments without an update keep their index
+    blocks = dict(previous["blocks"]) if previous is not None else {}
+    indexes = dict(previous["indexes"]) if previous is not None else {}
+    for name, (block, df) in updates.items():
+        with instrumentation.stage("snapshot.index", rows_in=len(df)):
+            indexes[name] = snapshot_index.build_snapshot_index(df)
+        blocks[name] = block
+    if len(blocks) > 1:
+        merged_df = deployments.merge_snapshots({name: snapshot_index.expand_positions(indexes[name]) for name in blocks})
+        with instrumentation.stage("snapshot.merge", rows_in=len(merged_df)):
+            indexes[ALL_DEPLOYMENTS] = snapshot_index.build_snapshot_index(merged_df)
+    return {"blocks": blocks, "indexes": indexes}
 
-sg = Subgrounds()
-lending = sg.load_subgraph(url)
+@st.experimental_singleton
+def get_snapshot_state():
+    # deployments whose last refresh failed, refreshes run in a background thread. The errors themselves
+    # only go to the log, they can carry the subgraph URL and with it a gateway API key
+    state = {"lock": threading.Lock(), "snapshot": None, "synced_at": 0, "checked_at": 0, "failed": []}
+    # warm start from the newest snapshots on disk, they get patched forward on the next refresh
+    latest = deployments.load_latest_snapshots(deployment_urls)
+    if latest:
+        state["snapshot"] = build_snapshot(None, latest)
+        state["synced_at"] = time.time()
+    return state
+
+def load_published_snapshots(state):
+    snapshot = state["snapshot"]
+    return deployments.load_latest_snapshots(deployment_urls, newer_than=snapshot["blocks"] if snapshot is not None else None)
+
+def fetch_snapshots(state):
+    snapshot = state["snapshot"]
+    previous = {}
+    if snapshot is not None:
+        # the index drops position ids, the stored frames keep them for patching by id
+        for name, block in snapshot["blocks"].items():
+            previous_df = snapshot_store.load_snapshot(deployment_urls[name], snapshot_store.OPEN_POSITIONS, block)
+            if previous_df is not None:
+                previous[name] = (block, previous_df)
+    full_scan = time.time() - state["synced_at"] > worker.FULL_RESYNC_SECONDS
+    results, errors = worker.build_open_positions_snapshots(deployment_urls, previous, full_scan=full_scan)
+    state["failed"] = list(errors)
+    for name, error in errors.items():
+        logger.error("Refreshing open positions failed for %s", name, exc_info=error)
+        instrumentation.emit("error", "open_positions.refresh", deployment=name, error=repr(error))
+    if errors and len(errors) == len(deployment_urls):
+        raise RuntimeError("Refreshing open positions failed for every deployment, see the log for details") from None
+    if full_scan:
+        state["synced_at"] = time.time()
+    updates = {name: result for name, result in results.items() if result is not None}
+    for name, result in updates.items():
+        snapshot_store.save_snapshot(deployment_urls[name], snapshot_store.OPEN_POSITIONS, *result)
+    return updates
+
+def refresh_snapshot(state):
+    with state["lock"]:
+        state["checked_at"] = time.time()
+        updates = load_published_snapshots(state) if external_snapshot_worker else fetch_snapshots(state)
+        if updates:
+            # swapped in one assignment so readers never see a frame with a stale index
+            state["snapshot"] = build_snapshot(state["snapshot"], updates)
+    if metrics_file:
+        instrumentation.write_prometheus(metrics_file)
 
-@st.experimental_memo(ttl=43200)
 def get_initial_data():
-    block = utils.get_lastest_synced_block_number(url)
-    return utils.get_all_open_positions(url, block)
+    state = get_snapshot_state()
+    if state["snapshot"] is None:
+        # cold start with nothing on disk, this session has to wait
+        refresh_snapshot(state)
+    elif time.time() - state["checked_at"] > REFRESH_SECONDS and not state["lock"].locked():
+        threading.Thread(target=refresh_snapshot, args=(state,), daemon=True).start()
+    return state["snapshot"]
+
+def load_or_fetch_snapshot(url, kind, block, key, fetch):
+    df = snapshot_store.load_snapshot(url, kind, block, key)
+    instrumentation.record_cache(f"snapshot_store.{kind}", hit=df is not None)
+    if df is None:
+        df = fetch()
+        snapshot_store.save_snapshot(url, kind, block, df, key)
+    return df
+
+@st.experimental_memo(ttl=REFRESH_SECONDS)
+def get_daily_snapshot_block(url):
+    return utils.get_latest_daily_snapshot_block(url)
 
-open_positions_df = get_initial_data()
+def show_performance_panel(events, render_seconds):
+    st.sidebar.metric("Render time", f"{render_seconds:.2f}s")
+    events_df = pd.DataFrame(events, columns=["kind", "name", "seconds", "bytes", "retries", "rows_in", "rows_out", "hit", "count"])
+    stages_df = events_df[events_df["kind"] == "stage"]
+    st.sidebar.write("Stages")
+    st.sidebar.dataframe(stages_df.groupby("name").agg(
+        runs=("name", "size"), seconds=("seconds", "sum"), rows_in=("rows_in", "sum"), rows_out=("rows_out", "sum")))
+    requests_df = events_df[events_df["kind"] == "request"]
+    st.sidebar.write("Subgraph requests")
+    st.sidebar.dataframe(requests_df.groupby("name").agg(
+        pages=("name", "size"), seconds=("seconds", "sum"), kb=("bytes", lambda b: b.sum() / 1024), retries=("retries", "sum")))
+    caches_df = events_df[events_df["kind"] == "cache"]
+    st.sidebar.write("Caches")
+    st.sidebar.dataframe(caches_df.pivot_table(index="name", columns="hit", values="count", aggfunc="sum", fill_value=0)
+                         .rename(columns={True: "hits", False: "misses"}))
+
+snapshot = get_initial_data()
+if snapshot is None:
+    st.info("Waiting for the snapshot worker to publish the first snapshot.")
+    st.stop()
+# configured deployments that have a snapshot yet, in the order of the secrets
+deployment_names = [name for name in deployment_urls if name in snapshot["blocks"]]
+for name in get_snapshot_state()["failed"]:
+    if name in snapshot["blocks"]:
+        st.warning(f"Refreshing {name} failed, showing its snapshot at block {snapshot['blocks'][name]:,}.")
+    else:
+        st.warning(f"Refreshing {name} failed, it has no snapshot yet.")
+
+DEPOSIT_COLUMNS = {
+    "market.inputToken.symbol": table_format.column("ASSET"),
+    "balance_adj": table_format.column("DEPOSIT AMOUNT", table_format.AMOUNT),
+    "market.inputTokenPriceUSD": table_format.column("CURRENT PRICE", table_format.CURRENCY),
+    "balance_usd": table_format.column("TOTAL DEPOSIT VALUE", table_format.CURRENCY, 0),
+    "percent_of_total_deposits": table_format.column("% OF TOTAL DEPOSITS", table_format.PERCENT),
+    "lender_variable_rate": table_format.column("APY", table_format.PERCENT),
+}
+BORROW_COLUMNS = {
+    "market.inputToken.symbol": table_format.column("ASSET"),
+    "market.inputTokenPriceUSD": table_format.column("CURRENT PRICE", table_format.CURRENCY),
+    "balance_adj": table_format.column("BORROWED AMOUNT", table_format.AMOUNT),
+    "balance_usd": table_format.column("TOTAL BORROWED VALUE", table_format.CURRENCY, 0),
+    "percent_of_total_borrows": table_format.column("% OF TOTAL BORROWS", table_format.PERCENT),
+    "borrower_variable_rate": table_format.column("APY VARIABLE", table_format.PERCENT),
+    "borrower_stable_rate": table_format.column("APY STABLE", table_format.PERCENT),
+}
+MOVER_COLUMNS = {
+    "account_id": table_format.column("ADDRESS"),
+    "deposits_usd": table_format.column("CURRENT DEPOSITS", table_format.CURRENCY, 0),
+    "deposits_change_usd": table_format.column("DEPOSIT CHANGE", table_format.CURRENCY, 0),
+    "borrows_usd": table_format.column("CURRENT BORROWS", table_format.CURRENCY, 0),
+    "borrows_change_usd": table_format.column("BORROW CHANGE", table_format.CURRENCY, 0),
+    "opened": table_format.column("POSITIONS OPENED"),
+    "closed": table_format.column("POSITIONS CLOSED"),
+}
+EVENT_COLUMNS = {
+    "date": table_format.column("DATE"),
+    "event": table_format.column("TRANSACTION"),
+    "asset.symbol": table_format.column("ASSET"),
+    "amount_adj": table_format.column("AMOUNT", table_format.AMOUNT),
+    "amountUSD": table_format.column("VALUE", table_format.CURRENCY),
+}
+
+# prepended to the detail tables when positions of several deployments are shown together
+DEPLOYMENT_COLUMNS = {deployments.DEPLOYMENT_COLUMN: table_format.column("DEPLOYMENT")}
+
+def deployment_blocks(deployment):
+    """{deployment name: block} behind a deployment selection"""
+    if deployment == ALL_DEPLOYMENTS:
+        return dict(snapshot["blocks"])
+    return {deployment: snapshot["blocks"][deployment]}
 
 placeholder = st.empty()
 with placeholder.container():
-    whale_type_select = st.selectbox("Show Top 100", ('Depositors', 'Borrowers'))
-    if whale_type_select == "Depositors":
-        position_side = "LENDER"
-        position_side_column_label = "CURRENT DEPOSITS"
-        number_assets_column_label = "NO. OF UNIQUE ASSETS DEPOSITED"
+    if len(deployment_names) > 1:
+        deployment = st.selectbox("Deployment", [ALL_DEPLOYMENTS] + deployment_names)
     else:
-        position_side = "BORROWER"
-        position_side_column_label = "CURRENT BORROWS"
-        number_assets_column_label = "NO. OF UNIQUE ASSETS BORROWED"
-    sided_df = open_positions_df[(open_positions_df["side"] == position_side)]
+        deployment = deployment_names[0]
+    index = snapshot["indexes"][deployment]
+    whale_type_select = st.selectbox("Show", ('Depositors', 'Borrowers', 'Movers'))
+    if whale_type_select == "Movers":
+        # older snapshots retained in the store, per deployment
+        retained_blocks = {
+            name: [block for block in snapshot_store.list_snapshots(deployment_urls[name], snapshot_store.OPEN_POSITIONS) if block < current_block]
+            for name, current_block in deployment_blocks(deployment).items()}
+        depth = max(len(blocks) for blocks in retained_blocks.values())
+        selection = None
+        if not depth:
+            st.info("No earlier snapshot is retained yet, movers show up once the next snapshot is taken.")
+        else:
+            mcol1, mcol2 = st.columns(2)
+            snapshots_back = mcol1.selectbox(
+                "Compare with", range(1, depth + 1), format_func=lambda n: "Previous snapshot" if n == 1 else f"{n} snapshots back")
+            rank_by = MOVER_SORTS[mcol2.selectbox("Rank by", list(MOVER_SORTS))]
 
-    agg_df = sided_df.groupby("account_id", as_index=False).agg(
-        usd_value=('balance_usd', 'sum'),
-        asset_count=('market.inputToken.symbol', 'count')
-    ).sort_values(
-        ["usd_value"], 
-        ascending=False
-    )[:100].reset_index(drop=True)
+            @st.experimental_memo(ttl=43200)
+            def get_movers_df(url, before_block, after_block):
+                before_df = snapshot_store.load_snapshot(url, snapshot_store.OPEN_POSITIONS, before_block, columns=snapshot_diff.SNAPSHOT_COLUMNS)
+                after_df = snapshot_store.load_snapshot(url, snapshot_store.OPEN_POSITIONS, after_block, columns=snapshot_diff.SNAPSHOT_COLUMNS)
+                if before_df is None or after_df is None:
+                    return None
+                return snapshot_diff.diff_snapshots(before_df, after_df)["accounts"]
+            with instrumentation.stage("movers.diff") as info:
+                compared_blocks = {
+                    name: blocks[-min(snapshots_back, len(blocks))] for name, blocks in retained_blocks.items() if blocks}
+                movers_frames = [get_movers_df(deployment_urls[name], block, snapshot["blocks"][name]) for name, block in compared_blocks.items()]
+                # a snapshot pruned since it was listed leaves that deployment out
+                movers_df = pd.concat([df for df in movers_frames if df is not None] or [pd.DataFrame(columns=snapshot_diff.ACCOUNT_COLUMNS)], ignore_index=True)
+                if len(compared_blocks) > 1:
+                    movers_df = movers_df.groupby("account_id", as_index=False, sort=False).sum()
+                agg_df = snapshot_diff.top_movers(movers_df, rank_by, MOVERS_COUNT)
+                info["rows_out"] = len(agg_df)
+            since = f" since block {next(iter(compared_blocks.values())):,}" if len(compared_blocks) == 1 else ""
+            st.caption(f"{len(movers_df):,} accounts moved{since}, {movers_df['opened'].sum():,} positions opened and {movers_df['closed'].sum():,} closed")
+            with instrumentation.stage("movers.format", rows_in=len(agg_df)):
+                selection = utils.aggrid_interactive_table(agg_df, MOVER_COLUMNS)
+    else:
+        if whale_type_select == "Depositors":
+            position_side = "LENDER"
+            position_side_column_label = "CURRENT DEPOSITS"
+            number_assets_column_label = "NO. OF UNIQUE ASSETS DEPOSITED"
+        else:
+            position_side = "BORROWER"
+            position_side_column_label = "CURRENT BORROWS"
+            number_assets_column_label = "NO. OF UNIQUE ASSETS BORROWED"
 
+        # every account is browsable, but only the current page is computed and sent to the grid
+        fcol1, fcol2, fcol3, fcol4 = st.columns([3, 2, 2, 1])
+        address_prefix = fcol1.text_input("Search address").strip()
+        min_usd_value = fcol2.number_input("Minimum value (USD)", min_value=0.0, value=0.0, step=100000.0)
+        sort_by = LEADERBOARD_SORTS[fcol3.selectbox("Sort by", list(LEADERBOARD_SORTS))]
+        ascending = fcol4.checkbox("Ascending")
+        leaderboard_query = dict(
+            side=position_side, sort_by=sort_by, descending=not ascending,
+            min_usd_value=min_usd_value or None, address_prefix=address_prefix or None)
+        with instrumentation.stage("leaderboard.query") as info:
+            total, _ = snapshot_index.query_leaderboard(index, stop=0, **leaderboard_query)
+            page_count = max(1, -(-total // LEADERBOARD_PAGE_SIZE))
+            # keyed on the query so the page resets whenever the filters change
+            page = st.number_input("Page", min_value=1, max_value=page_count, value=1, step=1, key=f"page-{deployment}-{leaderboard_query}")
+            start = (page - 1) * LEADERBOARD_PAGE_SIZE
+            _, agg_df = snapshot_index.query_leaderboard(index, start=start, stop=start + LEADERBOARD_PAGE_SIZE, **leaderboard_query)
+            info["rows_out"] = len(agg_df)
+        st.caption(f"{start + min(1, total):,}-{start + len(agg_df):,} of {total:,} accounts")
+        is_default_view = page == 1 and sort_by == "usd_value" and not ascending and not min_usd_value and not address_prefix
 
-    agg_df["usd_value"] = agg_df["usd_value"].apply(lambda x: "${:,.0f}".format(x))
-    agg_df.rename(columns={"account_id": "ADDRESS", "usd_value": position_side_column_label, "asset_count": number_assets_column_label}, inplace=True)
-    selection = utils.aggrid_interactive_table(agg_df)
+        leaderboard_columns = {
+            "account_id": table_format.column("ADDRESS"),
+            "usd_value": table_format.column(position_side_column_label, table_format.CURRENCY, 0),
+            "asset_count": table_format.column(number_assets_column_label)}
+
+        # one bulk history request per block for the whole page, so it's opt-in to keep the first render fast
+        if st.checkbox("Show 7D / 30D change") and len(agg_df):
+            # keyed by the newest daily snapshot block like the account history, the stored frame is
+            # keyed by the accounts it holds so a changed top page is fetched again
+            @st.experimental_memo(ttl=43200)
+            def get_leaderboard_history_df(url, account_ids, block, persist):
+                fetch = lambda: utils.get_accounts_daily_positions(url, list(account_ids), 31)
+                # only the default top page is stored, other pages would leave a snapshot directory each
+                if not persist:
+                    return fetch()
+                key = hashlib.sha1(" ".join(account_ids).encode()).hexdigest()[:16]
+                df = load_or_fetch_snapshot(url, snapshot_store.LEADERBOARD_HISTORY, block, key, fetch)
+                return df
+            # merged pages only ask each deployment for the accounts it holds
+            history_frames = []
+            for name in deployment_blocks(deployment):
+                url = deployment_urls[name]
+                account_ids = agg_df["account_id"][snapshot_index.has_accounts(snapshot["indexes"][name], agg_df["account_id"])]
+                if len(account_ids):
+                    history_frames.append(get_leaderboard_history_df(url, tuple(account_ids), get_daily_snapshot_block(url), is_default_view))
+            leaderboard_history_df = pd.concat(history_frames, ignore_index=True)
+            agg_df = snapshot_index.add_history_changes(agg_df, leaderboard_history_df, position_side)
+            leaderboard_columns["change_7d"] = table_format.column("7D CHANGE", table_format.PERCENT)
+            leaderboard_columns["change_30d"] = table_format.column("30D CHANGE", table_format.PERCENT)
+
+        with instrumentation.stage("leaderboard.format", rows_in=len(agg_df)):
+            selection = utils.aggrid_interactive_table(agg_df, leaderboard_columns)
 
 
 
 if selection:
     try:
-        selected_address = selection["selected_rows"][0]["ADDRESS"]
+        selected_address = selection["selected_rows"][0]["account_id"]
+        # plotly is only needed by the detail view, keep it off the leaderboard's cold start
+        import plotly.express as px
         placeholder.empty()
         with nav_container:
             if st.button("< Back"):
                 refresh_component()
         # DEPOSITS
-        address_deposit_positions = open_positions_df[(open_positions_df["side"] == "LENDER") & (open_positions_df["account_id"] == selected_address)].copy()
+        address_deposit_positions = snapshot_index.get_account_positions(index, selected_address, "LENDER").copy()
         current_deposited_metric = address_deposit_positions["balance_usd"].sum()
-        address_deposit_positions["percent_of_total_deposits"] = address_deposit_positions["balance_usd"] / address_deposit_positions["totalDepositBalanceUSD"]
-        display_user_deposits_df = address_deposit_positions[["market.inputToken.symbol", "balance_adj", "market.inputTokenPriceUSD", "balance_usd", "percent_of_total_deposits", "lender_variable_rate"]].copy()
-        display_user_deposits_df["balance_usd"] = display_user_deposits_df["balance_usd"].apply(lambda x: "${:,.0f}".format(x))
-        display_user_deposits_df["balance_adj"] = display_user_deposits_df["balance_adj"].apply(lambda x: "{:,.2f}".format(x))
-        display_user_deposits_df["market.inputTokenPriceUSD"] = display_user_deposits_df["market.inputTokenPriceUSD"].apply(lambda x: "${:,.2f}".format(x))
-        display_user_deposits_df["percent_of_total_deposits"] = display_user_deposits_df["percent_of_total_deposits"].apply(lambda x: "{:,.2f}%".format(x))
-        display_user_deposits_df["lender_variable_rate"] = display_user_deposits_df["lender_variable_rate"].apply(lambda x: "{:,.2f}%".format(x))
-        display_user_deposits_df.rename(columns={
-            "market.inputToken.symbol": "ASSET", "balance_adj": "DEPOSIT AMOUNT", "market.inputTokenPriceUSD": "CURRENT PRICE",
-            "balance_usd": "TOTAL DEPOSIT VALUE", "percent_of_total_deposits": "% OF TOTAL DEPOSITS", "lender_variable_rate": "APY"}, inplace=True)
+        address_deposit_positions["percent_of_total_deposits"] = 100 * address_deposit_positions["balance_usd"] / address_deposit_positions["totalDepositBalanceUSD"]
         #BORROWS
-        address_borrow_positions = open_positions_df[(open_positions_df["side"] == "BORROWER") & (open_positions_df["account_id"] == selected_address)].copy()
+        address_borrow_positions = snapshot_index.get_account_positions(index, selected_address, "BORROWER").copy()
         current_borrowed_metric = address_borrow_positions["balance_usd"].sum()
-        address_borrow_positions["percent_of_total_borrows"] = address_borrow_positions["balance_usd"] / address_borrow_positions["totalBorrowBalanceUSD"]
-        display_user_borrows_df = address_borrow_positions[["market.inputToken.symbol", "market.inputTokenPriceUSD", "balance_adj", "balance_usd", "percent_of_total_borrows", "borrower_variable_rate", "borrower_stable_rate"]].copy()
-        display_user_borrows_df["balance_usd"] = display_user_borrows_df["balance_usd"].apply(lambda x: "${:,.0f}".format(x))
-        display_user_borrows_df["balance_adj"] = display_user_borrows_df["balance_adj"].apply(lambda x: "{:,.2f}".format(x))
-        display_user_borrows_df["market.inputTokenPriceUSD"] = display_user_borrows_df["market.inputTokenPriceUSD"].apply(lambda x: "${:,.2f}".format(x))
-        display_user_borrows_df["percent_of_total_borrows"] = display_user_borrows_df["percent_of_total_borrows"].apply(lambda x: "{:,.2f}%".format(x))
-        display_user_borrows_df["borrower_variable_rate"] = display_user_borrows_df["borrower_variable_rate"].apply(lambda x: "{:,.2f}%".format(x))
-        display_user_borrows_df["borrower_stable_rate"] = display_user_borrows_df["borrower_stable_rate"].apply(lambda x: "{:,.2f}%".format(x))
-        display_user_borrows_df.rename(columns={
-            "market.inputToken.symbol": "ASSET", "balance_adj": "BORROWED AMOUNT", "market.inputTokenPriceUSD": "CURRENT PRICE",
-            "balance_usd": "TOTAL BORROWED VALUE", "percent_of_total_borrows": "% OF TOTAL BORROWS", "borrower_variable_rate": "APY VARIABLE", "borrower_stable_rate": "APY STABLE"}, inplace=True)
+        address_borrow_positions["percent_of_total_borrows"] = 100 * address_borrow_positions["balance_usd"] / address_borrow_positions["totalBorrowBalanceUSD"]
+        # history and events come from every deployment the account holds positions on, movers that
+        # closed everything are looked up on all of them
+        account_blocks = {
+            name: block for name, block in deployment_blocks(deployment).items()
+            if snapshot_index.has_accounts(snapshot["indexes"][name], [selected_address])[0]} or deployment_blocks(deployment)
+        table_prefix = DEPLOYMENT_COLUMNS if deployment == ALL_DEPLOYMENTS else {}
 
         st.subheader(selected_address)
         # line chart
-        # @st.experimental_memo(ttl=43200)
-        def get_time_series_df(url, selected_address, days_back):
-            df = utils.get_account_daily_positions(url, selected_address, days_back)
+        # keyed by the newest daily snapshot block, the history only changes when that does
+        @st.experimental_memo(ttl=43200)
+        def get_time_series_df(url, selected_address, days_back, block):
+            df = load_or_fetch_snapshot(
+                url, snapshot_store.DAILY_POSITIONS, block, f"{selected_address}-{days_back}d",
+                lambda: utils.get_account_daily_positions(url, selected_address, days_back))
             return df
-        time_series_df = get_time_series_df(url, selected_address, 30)   
+        time_series_df = pd.concat([
+            get_time_series_df(deployment_urls[name], selected_address, 30, get_daily_snapshot_block(deployment_urls[name]))
+            for name in account_blocks])
+        if len(account_blocks) > 1:
+            # deployments take their daily snapshots at different times, so they are added up per calendar day
+            time_series_df = time_series_df.groupby(time_series_df["date"].dt.normalize())[["borrows_usd", "deposits_usd"]].sum().reset_index()
         fig = px.line(time_series_df, x="date", y=["borrows_usd", "deposits_usd"])
         @st.experimental_memo(ttl=43200)
-        def get_account_events_df(url, selected_address):
-            df = utils.get_account_events(url, selected_address)
+        def get_account_events_df(url, selected_address, block):
+            df = load_or_fetch_snapshot(
+                url, snapshot_store.ACCOUNT_EVENTS, block, selected_address,
+                lambda: utils.get_account_events(url, selected_address))
             return df
-        events_df = get_account_events_df(url, selected_address)
+        events_df = pd.concat([
+            get_account_events_df(deployment_urls[name], selected_address, block).assign(**{deployments.DEPLOYMENT_COLUMN: name})
+            for name, block in account_blocks.items()]).sort_index(ascending=False)
         transaction_count = len(events_df.sort_index().loc[datetime.datetime.now() - pd.to_timedelta("30day"):])
-        events_df["amountUSD"] = events_df["amountUSD"].apply(lambda x: "${:,.2f}".format(x))
-        events_df["amount_adj"] = events_df["amount_adj"].apply(lambda x: "{:,.2f}".format(x))
-        events_df.rename(columns={"event": "TRANSACTION", "asset.symbol": "ASSET", "amount_adj": "AMOUNT", "amountUSD": "VALUE"}, inplace=True)
         col1, col2 = st.columns([1, 4])
         with col1:
             st.metric("Current Deposits", "$" + millify(current_deposited_metric, precision=2))
             st.metric("Current Borrowed", "$" + millify(current_borrowed_metric, precision=2))
             st.metric("Transaction Count (30D)", transaction_count)
         col2.plotly_chart(fig, use_container_width=True)
-        st.write("Deposits")        
-        st.write(display_user_deposits_df)
-        st.write("Borrows")
-        st.write(display_user_borrows_df)
-        lcol1, lcol2 = st.columns(2)
-        fig_d = px.pie(address_deposit_positions, values='balance_usd', names='market.inputToken.symbol', title='DEPOSIT COMPOSITION', color_discrete_sequence=px.colors.qualitative.D3)
-        fig_b = px.pie(address_borrow_positions, values='balance_usd', names='market.inputToken.symbol', title='BORROW COMPOSITION', color_discrete_sequence=px.colors.qualitative.D3)
-        lcol1.plotly_chart(fig_d, use_container_width=True)
-        lcol2.plotly_chart(fig_b, use_container_width=True)
-        st.write("Historical Transactions")
-        st.write(events_df)
+        with instrumentation.stage("detail.format"):
+            st.write("Deposits")
+            table_format.display_table(address_deposit_positions, {**table_prefix, **DEPOSIT_COLUMNS}, key="deposits")
+            st.write("Borrows")
+            table_format.display_table(address_borrow_positions, {**table_prefix, **BORROW_COLUMNS}, key="borrows")
+            lcol1, lcol2 = st.columns(2)
+            fig_d = px.pie(address_deposit_positions, values='balance_usd', names='market.inputToken.symbol', title='DEPOSIT COMPOSITION', color_discrete_sequence=px.colors.qualitative.D3)
+            fig_b = px.pie(address_borrow_positions, values='balance_usd', names='market.inputToken.symbol', title='BORROW COMPOSITION', color_discrete_sequence=px.colors.qualitative.D3)
+            lcol1.plotly_chart(fig_d, use_container_width=True)
+            lcol2.plotly_chart(fig_b, use_container_width=True)
+            st.write("Historical Transactions")
+            table_format.display_table(events_df.reset_index(), {**table_prefix, **EVENT_COLUMNS}, key="events")
     except IndexError:
         st.write("Select a row in the table to view detailed lending data for that address.")
 
 if st.button("Clear Cached Data"):
-    get_initial_data.clear()
-    get_initial_data()
\ No newline at end of file
+    state = get_snapshot_state()
+    # the next refresh rescans every deployment instead of patching the current snapshot, and
+    # runs in the background like the periodic one, or right after it if one is running
+    state["synced_at"] = 0
+    state["checked_at"] = 0
+    # per account data would otherwise come straight back from the store at the same block
+    for subgraph_url in deployment_urls.values():
+        for kind in (snapshot_store.DAILY_POSITIONS, snapshot_store.ACCOUNT_EVENTS, snapshot_store.LEADERBOARD_HISTORY):
+            snapshot_store.clear_snapshots(subgraph_url, kind)
+    utils.clear_account_caches()
+    st.experimental_memo.clear()
+    get_initial_data()
+    if external_snapshot_worker:
+        st.info("Cached data cleared, reloading the snapshots published by the worker.")
+    else:
+        st.info("Cached data cleared, rescanning every deployment in the background.")
+
+if show_performance:
+    show_performance_panel(render_events, time.perf_counter() - render_started)
+if metrics_file:
+    instrumentation.write_prometheus(metrics_file)
\ No newline at end of file
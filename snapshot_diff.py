@@ -0,0 +1,161 @@
+import numpy as np
+import pandas as pd
+from snapshot_index import SIDES
+
+# position status in a diff
+OPENED = "opened"
+CLOSED = "closed"
+CHANGED = "changed"
+
+ACCOUNT_COLUMNS = [
+    "account_id", "deposits_usd", "deposits_change_usd", "borrows_usd", "borrows_change_usd", "opened", "closed"]
+# snapshot columns diff_snapshots reads, the rest of a stored snapshot needn't be loaded
+SNAPSHOT_COLUMNS = [
+    "account_id", "side", "market.market_id", "market.inputToken.symbol", "market.inputTokenPriceUSD", "balance_adj"]
+POSITION_COLUMNS = [
+    "account_id", "side", "market.market_id", "market.inputToken.symbol", "status",
+    "balance_adj_before", "balance_adj", "change_usd"]
+
+
+def _position_keys(open_positions_df: pd.DataFrame, account_codes: np.ndarray, market_codes: np.ndarray, market_count: int) -> tuple:
+    """Sorted unique (account, market, side) keys of one snapshot with summed balances and prices
+
+    Snapshots are ordered by account, so with account codes in order of first appearance the
+    keys only need sorting within each account and the stable sort is close to linear.
+    """
+    sides = (open_positions_df["side"].to_numpy() == "BORROWER").astype(np.int64)
+    keys = (account_codes.astype(np.int64) * market_count + market_codes) * 2 + sides
+    order = np.argsort(keys, kind="stable")
+    keys = keys[order]
+    balances = open_positions_df["balance_adj"].to_numpy(dtype=np.float64)[order]
+    prices = open_positions_df["market.inputTokenPriceUSD"].to_numpy(dtype=np.float64)[order]
+    if not len(keys):
+        return keys, balances, prices
+    # stable and variable borrows of one market are separate positions with the same key
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    return keys[starts], np.add.reduceat(balances, starts), prices[starts]
+
+
+def _merge_keys(before_keys: np.ndarray, after_keys: np.ndarray) -> tuple:
+    """Merges two sorted unique key arrays
+
+    Returns:
+        tuple: (union of the keys, row of each key in before_keys or -1, row of each key in after_keys or -1)
+    """
+    merged = np.concatenate([before_keys, after_keys])
+    # timsort finds the two sorted runs and merges them in linear time
+    order = np.argsort(merged, kind="stable")
+    keys = merged[order]
+    if not len(keys):
+        return keys, order, order
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    # a key in both snapshots is two neighbouring entries, the before one first
+    ends = np.r_[starts[1:], len(keys)]
+    first = order[starts]
+    last = order[ends - 1]
+    before_rows = np.where(first < len(before_keys), first, -1)
+    after_rows = np.where(last >= len(before_keys), last - len(before_keys), -1)
+    return keys[starts], before_rows, after_rows
+
+
+def _take(values: np.ndarray, rows: np.ndarray, fill: float = 0.0) -> np.ndarray:
+    """values[rows] with fill where rows is -1"""
+    taken = np.full(len(rows), fill)
+    present = rows >= 0
+    taken[present] = values[rows[present]]
+    return taken
+
+
+def diff_snapshots(before_df: pd.DataFrame, after_df: pd.DataFrame) -> dict:
+    """Compares two open positions snapshots of the same deployment
+
+    Positions are matched on (account, market, side) with a merge of the two sorted key
+    arrays, everything else is a bincount over account codes, so the diff is linear in the
+    snapshot sizes. Balance changes are valued at the after snapshot's prices (the before
+    prices for closed positions) so price moves alone don't show up as movement.
+
+    Args:
+        before_df (pd.DataFrame): Older snapshot returned by utils.get_all_open_positions
+        after_df (pd.DataFrame): Newer snapshot of the same subgraph
+
+    Returns:
+        dict: {
+            "accounts": pd.DataFrame of every account with a changed position, with columns
+                ACCOUNT_COLUMNS. deposits_usd and borrows_usd are the after values,
+            "positions": pd.DataFrame of every opened, closed or changed position, with columns POSITION_COLUMNS
+        }
+    """
+    account_codes, account_ids = pd.factorize(pd.concat([before_df["account_id"], after_df["account_id"]], ignore_index=True))
+    market_ids = pd.concat([before_df["market.market_id"], after_df["market.market_id"]], ignore_index=True)
+    market_codes, market_uniques = pd.factorize(market_ids)
+    symbols = pd.concat([before_df["market.inputToken.symbol"], after_df["market.inputToken.symbol"]], ignore_index=True)
+    market_symbols = symbols.to_numpy()[np.unique(market_codes, return_index=True)[1]] if len(market_codes) else symbols.to_numpy()
+    market_count = max(len(market_uniques), 1)
+
+    split = len(before_df)
+    before_keys, before_balances, before_prices = _position_keys(before_df, account_codes[:split], market_codes[:split], market_count)
+    after_keys, after_balances, after_prices = _position_keys(after_df, account_codes[split:], market_codes[split:], market_count)
+    keys, before_rows, after_rows = _merge_keys(before_keys, after_keys)
+
+    balance_before = _take(before_balances, before_rows)
+    balance_after = _take(after_balances, after_rows)
+    price = np.where(after_rows >= 0, _take(after_prices, after_rows), _take(before_prices, before_rows))
+    is_changed = balance_before != balance_after
+    keys, before_rows, after_rows = keys[is_changed], before_rows[is_changed], after_rows[is_changed]
+    balance_before, balance_after, price = balance_before[is_changed], balance_after[is_changed], price[is_changed]
+
+    sides = keys % 2
+    markets = (keys // 2) % market_count
+    accounts = keys // 2 // market_count
+    status = np.where(before_rows < 0, OPENED, np.where(after_rows < 0, CLOSED, CHANGED))
+    change_usd = (balance_after - balance_before) * price
+    positions_df = pd.DataFrame({
+        "account_id": account_ids.take(accounts),
+        "side": np.array(SIDES)[sides],
+        "market.market_id": market_uniques.take(markets),
+        "market.inputToken.symbol": market_symbols[markets],
+        "status": status,
+        "balance_adj_before": balance_before,
+        "balance_adj": balance_after,
+        "change_usd": change_usd,
+    })
+
+    # after values of the moved accounts, including their unchanged positions
+    moved = np.unique(accounts)
+    after_accounts = after_keys // 2 // market_count
+    after_usd = after_balances * after_prices
+    is_borrow = (after_keys % 2).astype(bool)
+    minlength = len(account_ids)
+    accounts_df = pd.DataFrame({
+        "account_id": account_ids.take(moved),
+        "deposits_usd": np.bincount(after_accounts[~is_borrow], weights=after_usd[~is_borrow], minlength=minlength)[moved],
+        "deposits_change_usd": np.bincount(accounts[sides == 0], weights=change_usd[sides == 0], minlength=minlength)[moved],
+        "borrows_usd": np.bincount(after_accounts[is_borrow], weights=after_usd[is_borrow], minlength=minlength)[moved],
+        "borrows_change_usd": np.bincount(accounts[sides == 1], weights=change_usd[sides == 1], minlength=minlength)[moved],
+        "opened": np.bincount(accounts[status == OPENED], minlength=minlength)[moved],
+        "closed": np.bincount(accounts[status == CLOSED], minlength=minlength)[moved],
+    })
+    return {"accounts": accounts_df, "positions": positions_df}
+
+
+def top_movers(accounts_df: pd.DataFrame, by: str = "deposits_change_usd", n: int = 100) -> pd.DataFrame:
+    """Returns the n accounts with the largest absolute change in one column, largest first
+
+    Uses a partial sort, so only the n selected rows are fully sorted.
+
+    Args:
+        accounts_df (pd.DataFrame): "accounts" frame returned by diff_snapshots
+        by (str): Change column to rank by, "deposits_change_usd" or "borrows_change_usd"
+            (default is "deposits_change_usd")
+        n (int): Number of accounts
+            (default is 100)
+
+    Returns:
+        pd.DataFrame: Rows of accounts_df, accounts whose by column didn't change are left out
+    """
+    magnitude = np.abs(accounts_df[by].to_numpy())
+    candidates = np.flatnonzero(magnitude)
+    if len(candidates) > n:
+        candidates = candidates[np.argpartition(-magnitude[candidates], n - 1)[:n]]
+    candidates = candidates[np.argsort(-magnitude[candidates], kind="stable")]
+    return accounts_df.iloc[candidates].reset_index(drop=True)
@@ -0,0 +1,285 @@
+import numpy as np
+import pandas as pd
+import utils
+from deployments import DEPLOYMENT_COLUMN
+
+SIDES = ("LENDER", "BORROWER")
+# leaderboard columns query_leaderboard can sort by, leaderboards are stored sorted by usd_value
+SORT_KEYS = ("usd_value", "asset_count", "account_id")
+
+# columns of expanded snapshots, position ids aren't kept in the index. Snapshots are patched
+# from the stored frames, which have them
+EXPANDED_COLUMNS = [column for column in utils.OPEN_POSITIONS_COLUMNS if column != "position_id"]
+
+# per market attributes, stored once per market instead of on every position
+MARKET_COLUMNS = [
+    "market.market_id", "market.inputToken.symbol", "market.inputTokenPriceUSD",
+    "totalBorrowBalanceUSD", "totalDepositBalanceUSD"] + utils.RATE_COLUMNS
+
+
+def encode_account_ids(account_ids) -> np.ndarray:
+    """Packs 0x prefixed hex addresses into 20 byte binary ids
+
+    Lowercase hex and the packed bytes sort in the same order, so sorted input stays sorted.
+    """
+    return np.array([bytes.fromhex(account_id[2:]) for account_id in account_ids], dtype="S20")
+
+
+def decode_account_ids(accounts: np.ndarray) -> list:
+    # fixed width bytes drop trailing NULs, ljust restores them
+    return ["0x" + account.ljust(20, b"\0").hex() for account in accounts]
+
+
+def build_snapshot_index(open_positions_df: pd.DataFrame) -> dict:
+    """Builds the compact structures the app reads on every rerun, once per snapshot
+
+    The snapshot is held in a dictionary encoded layout: account ids are 20 byte binary
+    values referenced by int32 codes, markets are a side table referenced by int16 codes
+    and side is categorical. Each position row is 15 bytes. Full rows with market
+    attributes and balance_usd are only rebuilt for the rows a caller asks for.
+
+    Frames merged across deployments keep their deployment column as a market attribute,
+    markets are then told apart by (deployment, market id) and accounts are ranked across
+    every deployment.
+
+    Args:
+        open_positions_df (pd.DataFrame): Snapshot returned by utils.get_all_open_positions, or
+            several merged by deployments.merge_snapshots
+
+    Returns:
+        dict: {
+            "accounts": np.ndarray of sorted unique account ids as S20,
+            "markets": pd.DataFrame with MARKET_COLUMNS (and deployment), one row per market code,
+            "positions": pd.DataFrame sorted by (account, side) with columns
+                ['account', 'side', 'market', 'balance_adj'],
+            "leaderboards": {side: pd.DataFrame of every account ranked by usd_value with columns
+                ['account', 'usd_value', 'asset_count']},
+            "sort_orders": {side: {sort key: np.ndarray of leaderboard rows in descending key order}},
+            "sort_ranks": {side: {sort key: np.ndarray of each leaderboard row's position in that order}},
+            "account_rows": {side: np.ndarray of each account code's leaderboard row, -1 if not on that side}
+        }
+    """
+    account_codes, account_ids = pd.factorize(open_positions_df["account_id"], sort=True)
+    market_columns = list(MARKET_COLUMNS)
+    market_keys = open_positions_df["market.market_id"]
+    if DEPLOYMENT_COLUMN in open_positions_df.columns:
+        market_columns.append(DEPLOYMENT_COLUMN)
+        market_keys = open_positions_df[DEPLOYMENT_COLUMN] + "/" + market_keys
+    market_codes, _ = pd.factorize(market_keys, sort=True)
+    # first row of every market code, in code order
+    _, first_rows = np.unique(market_codes, return_index=True)
+    markets_df = open_positions_df.iloc[first_rows][market_columns].reset_index(drop=True)
+
+    positions_df = pd.DataFrame({
+        "account": account_codes.astype(np.int32),
+        "side": pd.Categorical(open_positions_df["side"], categories=SIDES),
+        "market": market_codes.astype(np.int16),
+        "balance_adj": open_positions_df["balance_adj"].to_numpy(dtype=np.float64),
+    }).sort_values(["account", "side"], kind="stable", ignore_index=True)
+
+    balance_usd = positions_df["balance_adj"].to_numpy() * markets_df["market.inputTokenPriceUSD"].to_numpy()[positions_df["market"].to_numpy()]
+    leaderboards = {}
+    sort_orders = {}
+    sort_ranks = {}
+    account_rows = {}
+    for side in SIDES:
+        is_side = (positions_df["side"] == side).to_numpy()
+        accounts = positions_df["account"].to_numpy()[is_side]
+        usd_value = np.bincount(accounts, weights=balance_usd[is_side], minlength=len(account_ids))
+        asset_count = np.bincount(accounts, minlength=len(account_ids))
+        ranked = np.flatnonzero(asset_count)
+        ranked = ranked[np.argsort(-usd_value[ranked], kind="stable")]
+        leaderboards[side] = pd.DataFrame({
+            "account": ranked.astype(np.int32),
+            "usd_value": usd_value[ranked],
+            "asset_count": asset_count[ranked].astype(np.int16),
+        })
+
+        rows = np.arange(len(ranked), dtype=np.int32)
+        # ties keep the usd_value order, account codes are already in address order
+        sort_orders[side] = {
+            "usd_value": rows,
+            "asset_count": np.argsort(-asset_count[ranked], kind="stable").astype(np.int32),
+            "account_id": np.argsort(ranked, kind="stable").astype(np.int32)[::-1],
+        }
+        sort_ranks[side] = {}
+        for key, order in sort_orders[side].items():
+            sort_ranks[side][key] = np.empty(len(order), dtype=np.int32)
+            sort_ranks[side][key][order] = rows
+        account_rows[side] = np.full(len(account_ids), -1, dtype=np.int32)
+        account_rows[side][ranked] = rows
+
+    return {
+        "accounts": encode_account_ids(account_ids),
+        "markets": markets_df,
+        "positions": positions_df,
+        "leaderboards": leaderboards,
+        "sort_orders": sort_orders,
+        "sort_ranks": sort_ranks,
+        "account_rows": account_rows,
+    }
+
+
+def _expand_positions(snapshot_index: dict, positions_df: pd.DataFrame) -> pd.DataFrame:
+    """Joins market attributes and decoded account ids onto compact position rows"""
+    markets_df = snapshot_index["markets"].take(positions_df["market"].to_numpy()).reset_index(drop=True)
+    expanded_df = markets_df.assign(
+        account_id=decode_account_ids(snapshot_index["accounts"][positions_df["account"].to_numpy()]),
+        side=positions_df["side"].astype(str).to_numpy(),
+        balance_adj=positions_df["balance_adj"].to_numpy(),
+    )
+    expanded_df["balance_usd"] = expanded_df["balance_adj"] * expanded_df["market.inputTokenPriceUSD"]
+    if DEPLOYMENT_COLUMN in expanded_df.columns:
+        return expanded_df[EXPANDED_COLUMNS + [DEPLOYMENT_COLUMN]]
+    return expanded_df[EXPANDED_COLUMNS]
+
+
+def expand_positions(snapshot_index: dict) -> pd.DataFrame:
+    """Rebuilds the utils.get_all_open_positions frame without position ids, sorted by (account_id, side)
+
+    Indexes of merged frames also return the deployment column.
+    """
+    return _expand_positions(snapshot_index, snapshot_index["positions"])
+
+
+def _leaderboard_rows(snapshot_index: dict, side: str, rows) -> pd.DataFrame:
+    leaderboard_df = snapshot_index["leaderboards"][side].iloc[rows]
+    return pd.DataFrame({
+        "account_id": decode_account_ids(snapshot_index["accounts"][leaderboard_df["account"].to_numpy()]),
+        "usd_value": leaderboard_df["usd_value"].to_numpy(),
+        "asset_count": leaderboard_df["asset_count"].to_numpy(),
+    })
+
+
+def get_leaderboard(snapshot_index: dict, side: str, start: int = 0, stop: int = None) -> pd.DataFrame:
+    """Returns ranks start to stop of one side's leaderboard
+
+    Returns:
+        pd.DataFrame: Pandas DataFrame with columns ['account_id', 'usd_value', 'asset_count']
+    """
+    return _leaderboard_rows(snapshot_index, side, slice(start, stop))
+
+
+def _account_prefix_range(snapshot_index: dict, prefix: str) -> tuple:
+    """Range of account codes whose address starts with prefix, found by binary search"""
+    digits = prefix.lower().removeprefix("0x")
+    if len(digits) > 40 or any(digit not in "0123456789abcdef" for digit in digits):
+        return 0, 0
+    lower, upper = encode_account_ids(["0x" + digits.ljust(40, "0"), "0x" + digits.ljust(40, "f")])
+    accounts = snapshot_index["accounts"]
+    return int(np.searchsorted(accounts, lower, side="left")), int(np.searchsorted(accounts, upper, side="right"))
+
+
+def query_leaderboard(
+    snapshot_index: dict, side: str, sort_by: str = "usd_value", descending: bool = True,
+    min_usd_value: float = None, address_prefix: str = None, start: int = 0, stop: int = None
+) -> tuple:
+    """Returns one page of a filtered and sorted leaderboard without copying the rest
+
+    Filters narrow the precomputed orders with binary searches: the usd_value cutoff on the
+    leaderboard itself and the address prefix on the sorted binary account ids.
+
+    Args:
+        snapshot_index (dict): Index returned by build_snapshot_index
+        side (str): "LENDER" or "BORROWER"
+        sort_by (str): One of SORT_KEYS
+            (default is "usd_value")
+        descending (bool): Sort direction
+            (default is True)
+        min_usd_value (float): Only accounts with at least this usd_value
+            (default is None)
+        address_prefix (str): Only accounts whose address starts with this hex prefix, with or without 0x
+            (default is None)
+        start (int): First row of the page in the filtered and sorted leaderboard
+            (default is 0)
+        stop (int): Row after the last one of the page, None for all remaining rows
+            (default is None)
+
+    Returns:
+        tuple: (total number of matching accounts, pd.DataFrame of the page with columns
+            ['account_id', 'usd_value', 'asset_count'])
+    """
+    if sort_by not in SORT_KEYS:
+        raise ValueError(f"sort_by must be one of {SORT_KEYS}")
+    leaderboard_df = snapshot_index["leaderboards"][side]
+    # rows are usd_value ranks, so the cutoff is a prefix of the leaderboard
+    cutoff = len(leaderboard_df)
+    if min_usd_value is not None:
+        cutoff = int(np.searchsorted(-leaderboard_df["usd_value"].to_numpy(), -min_usd_value, side="right"))
+
+    if address_prefix:
+        lower, upper = _account_prefix_range(snapshot_index, address_prefix)
+        rows = snapshot_index["account_rows"][side][lower:upper]
+        rows = rows[(rows >= 0) & (rows < cutoff)]
+        ordered = rows[np.argsort(snapshot_index["sort_ranks"][side][sort_by][rows], kind="stable")]
+    elif sort_by == "usd_value":
+        ordered = snapshot_index["sort_orders"][side][sort_by][:cutoff]
+    else:
+        order = snapshot_index["sort_orders"][side][sort_by]
+        ordered = order[order < cutoff] if cutoff < len(order) else order
+
+    if not descending:
+        ordered = ordered[::-1]
+    return len(ordered), _leaderboard_rows(snapshot_index, side, ordered[start:stop])
+
+
+def has_accounts(snapshot_index: dict, account_ids) -> np.ndarray:
+    """Returns a boolean array telling which of account_ids hold any position in the snapshot"""
+    accounts = snapshot_index["accounts"]
+    encoded = encode_account_ids(account_ids)
+    if not len(accounts):
+        return np.zeros(len(encoded), dtype=bool)
+    codes = np.minimum(np.searchsorted(accounts, encoded), len(accounts) - 1)
+    return accounts[codes] == encoded
+
+
+def get_account_positions(snapshot_index: dict, account_id: str, side: str) -> pd.DataFrame:
+    """Returns one account's positions on one side without scanning the snapshot
+
+    Args:
+        snapshot_index (dict): Index returned by build_snapshot_index
+        account_id (str): Account address
+        side (str): "LENDER" or "BORROWER"
+
+    Returns:
+        pd.DataFrame: Matching rows with EXPANDED_COLUMNS, empty if the account has none
+    """
+    accounts = snapshot_index["accounts"]
+    positions_df = snapshot_index["positions"]
+    account = encode_account_ids([account_id])[0]
+    code = np.searchsorted(accounts, account)
+    if code == len(accounts) or accounts[code] != account:
+        return _expand_positions(snapshot_index, positions_df.iloc[0:0])
+    start, stop = np.searchsorted(positions_df["account"].to_numpy(), [code, code + 1])
+    account_positions_df = positions_df.iloc[start:stop]
+    return _expand_positions(snapshot_index, account_positions_df[account_positions_df["side"] == side])
+
+
+def add_history_changes(leaderboard_df: pd.DataFrame, history_df: pd.DataFrame, side: str, days: tuple = (7, 30)) -> pd.DataFrame:
+    """Adds the percent change of each account's usd_value over the past days
+
+    Args:
+        leaderboard_df (pd.DataFrame): Frame returned by get_leaderboard
+        history_df (pd.DataFrame): Frame returned by utils.get_accounts_daily_positions for the same accounts,
+            with at least max(days) + 1 daily snapshots, or several of them concatenated across deployments
+        side (str): "LENDER" or "BORROWER"
+        days (tuple): Periods to compare against, in daily snapshots before the latest one
+            (default is (7, 30))
+
+    Returns:
+        pd.DataFrame: leaderboard_df with a change_<n>d column per period, NaN where the account
+            had nothing on that side n days ago or the history doesn't reach back that far
+    """
+    value_column = "deposits_usd" if side == "LENDER" else "borrows_usd"
+    # keyed by calendar day so histories of several deployments, taken at different blocks, add up
+    days_df = history_df.assign(day=history_df["date"].dt.normalize())
+    snapshot_days = sorted(days_df["day"].unique(), reverse=True)
+    values_by_day = days_df.pivot_table(index="account_id", columns="day", values=value_column, aggfunc="sum")
+    leaderboard_df = leaderboard_df.copy()
+    for n in days:
+        if n < len(snapshot_days):
+            past_values = leaderboard_df["account_id"].map(values_by_day[snapshot_days[n]]).replace(0, float("nan"))
+        else:
+            past_values = pd.Series(float("nan"), index=leaderboard_df.index)
+        leaderboard_df[f"change_{n}d"] = 100 * (leaderboard_df["usd_value"] / past_values - 1)
+    return leaderboard_df
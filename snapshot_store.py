@@ -0,0 +1,164 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+SNAPSHOT_DIR = os.environ.get("WHALE_SNAPSHOT_DIR", ".snapshots")
+RETAIN_SNAPSHOTS = 24
+# keyed kinds get one directory per key, e.g. per viewed account. Only the newest block of a
+# key is read back, and only the most recently written keys are kept
+RETAIN_KEYED_SNAPSHOTS = 2
+RETAIN_KEYS = 500
+
+# snapshot kinds
+OPEN_POSITIONS = "open_positions"
+DAILY_POSITIONS = "daily_positions"
+ACCOUNT_EVENTS = "account_events"
+LEADERBOARD_HISTORY = "leaderboard_history"
+
+
+def _snapshot_dir(subgraph_url: str, kind: str, key: str = None) -> str:
+    """Directory holding every block of one snapshot kind, e.g. .snapshots/<url hash>/daily_positions/<account>"""
+    url_hash = hashlib.sha1(subgraph_url.encode()).hexdigest()[:16]
+    parts = [SNAPSHOT_DIR, url_hash, kind]
+    if key is not None:
+        parts.append(key)
+    return os.path.join(*parts)
+
+
+def _snapshot_path(snapshot_dir: str, block_num: int) -> str:
+    # zero padded so lexical and numeric order agree
+    return os.path.join(snapshot_dir, f"{block_num:012d}.parquet")
+
+
+def list_snapshots(subgraph_url: str, kind: str, key: str = None) -> list:
+    """Lists the block numbers stored for a snapshot kind without loading any of them
+
+    Args:
+        subgraph_url (str): URL of extended lending subgraph the snapshots were taken from
+        kind (str): Snapshot kind, one of OPEN_POSITIONS, DAILY_POSITIONS, ACCOUNT_EVENTS, LEADERBOARD_HISTORY
+        key (str): Optional sub key, e.g. account id for per account snapshots
+            (default is None)
+
+    Returns:
+        list: Block numbers in ascending order
+    """
+    snapshot_dir = _snapshot_dir(subgraph_url, kind, key)
+    try:
+        names = os.listdir(snapshot_dir)
+    except FileNotFoundError:
+        return []
+    return sorted(int(name[:-len(".parquet")]) for name in names if name.endswith(".parquet"))
+
+
+def save_snapshot(subgraph_url: str, kind: str, block_num: int, df: pd.DataFrame, key: str = None, retain: int = None) -> str:
+    """Writes a DataFrame as a Parquet snapshot and prunes old blocks and keys of the same kind
+
+    The file is written under a temporary name and renamed into place, so readers in
+    other processes never see a partial snapshot.
+
+    Args:
+        subgraph_url (str): URL of extended lending subgraph the snapshot was taken from
+        kind (str): Snapshot kind, one of OPEN_POSITIONS, DAILY_POSITIONS, ACCOUNT_EVENTS, LEADERBOARD_HISTORY
+        block_num (int): block height the snapshot was taken at
+        df (pd.DataFrame): Snapshot data
+        key (str): Optional sub key, e.g. account id for per account snapshots
+            (default is None)
+        retain (int): Number of most recent blocks to keep, None keeps RETAIN_SNAPSHOTS, or
+            RETAIN_KEYED_SNAPSHOTS for keyed snapshots
+            (default is None)
+
+    Returns:
+        str: Path of the written snapshot
+    """
+    snapshot_dir = _snapshot_dir(subgraph_url, kind, key)
+    os.makedirs(snapshot_dir, exist_ok=True)
+    path = _snapshot_path(snapshot_dir, block_num)
+    # a unique temporary name, sessions are threads of one process and may save the same block
+    fd, tmp_path = tempfile.mkstemp(dir=snapshot_dir, suffix=".tmp")
+    os.close(fd)
+    try:
+        pq.write_table(pa.Table.from_pandas(df), tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    if retain is None:
+        retain = RETAIN_SNAPSHOTS if key is None else RETAIN_KEYED_SNAPSHOTS
+    prune_snapshots(subgraph_url, kind, retain, key)
+    if key is not None:
+        prune_keys(subgraph_url, kind)
+    return path
+
+
+def load_snapshot(subgraph_url: str, kind: str, block_num: int, key: str = None, columns: list = None) -> pd.DataFrame:
+    """Reads one snapshot through a memory map, only the pages of the requested columns are touched
+
+    Args:
+        subgraph_url (str): URL of extended lending subgraph the snapshot was taken from
+        kind (str): Snapshot kind, one of OPEN_POSITIONS, DAILY_POSITIONS, ACCOUNT_EVENTS, LEADERBOARD_HISTORY
+        block_num (int): block height of the snapshot
+        key (str): Optional sub key, e.g. account id for per account snapshots
+            (default is None)
+        columns (list): Columns to read
+            (default is None, all columns)
+
+    Returns:
+        pd.DataFrame: The stored snapshot, or None if there is no snapshot at that block
+    """
+    path = _snapshot_path(_snapshot_dir(subgraph_url, kind, key), block_num)
+    # another session or replica may prune the file at any time, so there is no exists check
+    try:
+        table = pq.read_table(path, columns=columns, memory_map=True)
+    except FileNotFoundError:
+        return None
+    return table.to_pandas()
+
+
+def load_latest_snapshot(subgraph_url: str, kind: str, key: str = None) -> tuple:
+    """Reads the most recent snapshot of a kind
+
+    Returns:
+        tuple: (block_num, pd.DataFrame), or None if nothing is stored
+    """
+    blocks = list_snapshots(subgraph_url, kind, key)
+    if not blocks:
+        return None
+    df = load_snapshot(subgraph_url, kind, blocks[-1], key)
+    if df is None:
+        return None
+    return blocks[-1], df
+
+
+def prune_snapshots(subgraph_url: str, kind: str, retain: int = RETAIN_SNAPSHOTS, key: str = None):
+    """Deletes all but the newest `retain` snapshots of a kind"""
+    snapshot_dir = _snapshot_dir(subgraph_url, kind, key)
+    for block_num in list_snapshots(subgraph_url, kind, key)[:-retain or None]:
+        try:
+            os.remove(_snapshot_path(snapshot_dir, block_num))
+        except FileNotFoundError:
+            # already pruned by another session or replica
+            pass
+
+
+def clear_snapshots(subgraph_url: str, kind: str):
+    """Deletes every stored block and key of a snapshot kind"""
+    shutil.rmtree(_snapshot_dir(subgraph_url, kind), ignore_errors=True)
+
+
+def prune_keys(subgraph_url: str, kind: str, retain: int = RETAIN_KEYS):
+    """Deletes the directories of all but the `retain` most recently written keys of a kind"""
+    kind_dir = _snapshot_dir(subgraph_url, kind)
+    if not os.path.isdir(kind_dir):
+        return
+    key_dirs = [entry for entry in os.scandir(kind_dir) if entry.is_dir()]
+    if len(key_dirs) <= retain:
+        return
+    # a key directory's mtime changes whenever a snapshot is added to or pruned from it
+    key_dirs.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+    for entry in key_dirs[retain:]:
+        shutil.rmtree(entry.path, ignore_errors=True)
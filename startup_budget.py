@@ -0,0 +1,72 @@
+"""Checks the app's cold and warm startup against a time budget
+
+Usage:
+    python startup_budget.py [--subgraph-url URL ...]
+
+cold: a fresh interpreter importing everything the leaderboard view needs
+warm: loading the newest local open positions snapshot of every deployment and building
+    their indexes, plus the merged index when there are several, as the app does
+Exits with status 1 if either is over budget.
+"""
+import argparse
+import subprocess
+import sys
+import time
+import deployments
+import snapshot_index
+import worker
+
+COLD_IMPORT_BUDGET_SECONDS = 3.0
+WARM_START_BUDGET_SECONDS = 2.0
+
+_COLD_IMPORT_SCRIPT = """
+import time
+started = time.perf_counter()
+import streamlit, utils, instrumentation, snapshot_store, snapshot_index, snapshot_diff, deployments, table_format, worker
+import millify, refresh_component
+print(time.perf_counter() - started)
+"""
+
+
+def measure_cold_import() -> float:
+    """Seconds a new process spends importing the app's modules"""
+    output = subprocess.run([sys.executable, "-c", _COLD_IMPORT_SCRIPT], capture_output=True, text=True, check=True).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def measure_warm_start(subgraph_urls: dict) -> float:
+    """Seconds to serve the newest local snapshots, None if there is no snapshot on disk"""
+    started = time.perf_counter()
+    latest = deployments.load_latest_snapshots(subgraph_urls)
+    if not latest:
+        return None
+    indexes = {name: snapshot_index.build_snapshot_index(df) for name, (_, df) in latest.items()}
+    if len(indexes) > 1:
+        merged_df = deployments.merge_snapshots({name: snapshot_index.expand_positions(index) for name, index in indexes.items()})
+        snapshot_index.build_snapshot_index(merged_df)
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check Whale Watcher startup time against its budget")
+    parser.add_argument("--subgraph-url", action="append", help="repeat for several deployments, defaults to the worker's deployments")
+    args = parser.parse_args()
+    subgraph_urls = {url: url for url in args.subgraph_url} if args.subgraph_url else worker._default_deployments()
+
+    over_budget = False
+    cold = measure_cold_import()
+    over_budget |= cold > COLD_IMPORT_BUDGET_SECONDS
+    print(f"cold import: {cold:.2f}s (budget {COLD_IMPORT_BUDGET_SECONDS:.2f}s)")
+
+    warm = measure_warm_start(subgraph_urls) if subgraph_urls else None
+    if warm is None:
+        print("warm start: skipped, no local snapshot")
+    else:
+        over_budget |= warm > WARM_START_BUDGET_SECONDS
+        print(f"warm start: {warm:.2f}s (budget {WARM_START_BUDGET_SECONDS:.2f}s)")
+
+    sys.exit(1 if over_budget else 0)
+
+
+if __name__ == "__main__":
+    main()
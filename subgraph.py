@@ -0,0 +1,260 @@
+import asyncio
+import atexit
+import json
+import random
+import re
+import threading
+import time
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+import instrumentation
+
+# brotli is optional, only advertise it when responses can be decoded
+try:
+    import brotli  # noqa: F401
+    ACCEPT_ENCODING = "gzip, deflate, br"
+except ImportError:
+    ACCEPT_ENCODING = "gzip, deflate"
+
+# orjson is optional, it parses the large position pages several times faster than json
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads
+
+# per subgraph URL, so fanning out over several deployments doesn't share one budget
+MAX_IN_FLIGHT = 16
+MAX_SUBGRAPHS = 8
+MAX_RETRIES = 5
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_CAP_SECONDS = 30.0
+REQUEST_TIMEOUT_SECONDS = 60
+KEEPALIVE_TIMEOUT_SECONDS = 60
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# graph-node errors that go away on their own, e.g. an indexer lagging behind the requested block
+TRANSIENT_GRAPHQL_ERRORS = (
+    "has only indexed up to block",
+    "database unavailable",
+    "statement timeout",
+)
+
+HEADERS = {
+    "Accept": "application/json",
+    "Accept-Encoding": ACCEPT_ENCODING,
+    "Connection": "keep-alive",
+}
+
+
+class SubgraphError(Exception):
+    """Raised when a subgraph request fails permanently or still fails after all retries"""
+
+
+class _RetryableError(Exception):
+    def __init__(self, message: str, retry_after: float = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def _backoff_delay(attempt: int, retry_after: float = None) -> float:
+    """Full jitter exponential backoff, never shorter than a server provided Retry-After"""
+    delay = random.uniform(0, min(BACKOFF_CAP_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+
+def _retry_after(headers) -> float:
+    try:
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+def _operation_name(query: str) -> str:
+    """First root field of the query, used to label its metrics"""
+    match = re.search(r"\{\s*(?:(\w+)\s*:\s*)?(\w+)", query)
+    if match is None:
+        return "unknown"
+    # aliases such as the per block b<number> ones in the history query are grouped by field
+    return match.group(2)
+
+
+def _check_response(status: int, headers, body: bytes) -> dict:
+    """Returns the GraphQL `data` object
+
+    Raises:
+        _RetryableError: On 429 and 5xx responses and transient GraphQL errors
+        SubgraphError: On anything else, e.g. schema or validation errors, retrying can't fix those
+    """
+    if status in RETRY_STATUSES:
+        raise _RetryableError(f"HTTP {status}", _retry_after(headers))
+    try:
+        data = _loads(body)
+    except ValueError:
+        raise SubgraphError(f"HTTP {status}: response is not JSON: {body[:200]!r}")
+    if data.get("errors"):
+        messages = " ".join(str(error.get("message", error)) if isinstance(error, dict) else str(error) for error in data["errors"])
+        if any(message in messages for message in TRANSIENT_GRAPHQL_ERRORS):
+            raise _RetryableError(f"GraphQL errors: {data['errors']}")
+        raise SubgraphError(f"GraphQL errors: {data['errors']}")
+    if status >= 400 or data.get("data") is None:
+        raise SubgraphError(f"HTTP {status}: {data}")
+    return data["data"]
+
+
+# SYNC CLIENT
+_session = None
+_session_lock = threading.Lock()
+_sync_slots = {}
+
+
+def _get_sync_slots(subgraph_url: str) -> threading.BoundedSemaphore:
+    with _session_lock:
+        if subgraph_url not in _sync_slots:
+            _sync_slots[subgraph_url] = threading.BoundedSemaphore(MAX_IN_FLIGHT)
+        return _sync_slots[subgraph_url]
+
+
+def _get_session() -> requests.Session:
+    """Process wide keep-alive session, created on first use"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=MAX_SUBGRAPHS, pool_maxsize=MAX_IN_FLIGHT * MAX_SUBGRAPHS)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers.update(HEADERS)
+            _session = session
+        return _session
+
+
+def query(subgraph_url: str, query: str, variables: dict = None) -> dict:
+    """Posts a GraphQL query over the shared connection pool
+
+    Args:
+        subgraph_url (str): URL of extended lending subgraph
+        query (str): GraphQL query
+        variables (dict): GraphQL variables
+            (default is None)
+
+    Returns:
+        dict: The `data` object of the response
+
+    Raises:
+        SubgraphError: If the request fails with a permanent error, or a transient one still
+            fails after MAX_RETRIES retries
+    """
+    payload = {"query": query, "variables": variables or {}}
+    operation = _operation_name(query)
+    session = _get_session()
+    slots = _get_sync_slots(subgraph_url)
+    started = time.perf_counter()
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            with slots:
+                resp = session.post(subgraph_url, json=payload, timeout=REQUEST_TIMEOUT_SECONDS)
+            result = _check_response(resp.status_code, resp.headers, resp.content)
+            instrumentation.record_request(operation, time.perf_counter() - started, len(resp.content), attempt)
+            return result
+        except SubgraphError:
+            instrumentation.record_request(operation, time.perf_counter() - started, 0, attempt, ok=False)
+            raise
+        except (_RetryableError, requests.ConnectionError, requests.Timeout) as e:
+            if attempt == MAX_RETRIES:
+                instrumentation.record_request(operation, time.perf_counter() - started, 0, attempt, ok=False)
+                raise SubgraphError(f"failed after {MAX_RETRIES} retries: {e}") from e
+            time.sleep(_backoff_delay(attempt, getattr(e, "retry_after", None)))
+
+
+# ASYNC CLIENT
+# aiohttp sessions are bound to an event loop, so a single background loop owns the
+# shared session and every coroutine using async_query is run on it with run()
+_loop = None
+_loop_lock = threading.Lock()
+_async_session = None
+_async_slots = {}
+
+
+def _get_loop() -> asyncio.AbstractEventLoop:
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="subgraph-client", daemon=True).start()
+            _loop = loop
+        return _loop
+
+
+def _get_async_session() -> aiohttp.ClientSession:
+    """Keep-alive aiohttp session, created on first use inside the background loop"""
+    global _async_session
+    if _async_session is None or _async_session.closed:
+        connector = aiohttp.TCPConnector(limit=MAX_IN_FLIGHT * MAX_SUBGRAPHS, keepalive_timeout=KEEPALIVE_TIMEOUT_SECONDS)
+        _async_session = aiohttp.ClientSession(
+            connector=connector,
+            headers=HEADERS,
+            timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT_SECONDS),
+        )
+        _async_slots.clear()
+    return _async_session
+
+
+def _get_async_slots(subgraph_url: str) -> asyncio.Semaphore:
+    # only touched from the background loop, so no lock is needed
+    if subgraph_url not in _async_slots:
+        _async_slots[subgraph_url] = asyncio.Semaphore(MAX_IN_FLIGHT)
+    return _async_slots[subgraph_url]
+
+
+async def _with_collector(coro, collector: list):
+    # tasks created by coro copy this context, so their requests land in the caller's collector
+    with instrumentation.bind_collector(collector):
+        return await coro
+
+
+def run(coro):
+    """Runs a coroutine on the client's background loop and blocks until it returns"""
+    collector = instrumentation.current_collector()
+    if collector is not None:
+        coro = _with_collector(coro, collector)
+    return asyncio.run_coroutine_threadsafe(coro, _get_loop()).result()
+
+
+async def async_query(subgraph_url: str, query: str, variables: dict = None) -> dict:
+    """Async version of query, must be awaited inside a coroutine passed to run()"""
+    payload = {"query": query, "variables": variables or {}}
+    operation = _operation_name(query)
+    session = _get_async_session()
+    started = time.perf_counter()
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            async with _get_async_slots(subgraph_url):
+                async with session.post(subgraph_url, json=payload) as resp:
+                    body = await resp.read() if resp.status not in RETRY_STATUSES else b""
+                    result = _check_response(resp.status, resp.headers, body)
+            instrumentation.record_request(operation, time.perf_counter() - started, len(body), attempt)
+            return result
+        except SubgraphError:
+            instrumentation.record_request(operation, time.perf_counter() - started, 0, attempt, ok=False)
+            raise
+        except (_RetryableError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if attempt == MAX_RETRIES:
+                instrumentation.record_request(operation, time.perf_counter() - started, 0, attempt, ok=False)
+                raise SubgraphError(f"failed after {MAX_RETRIES} retries: {e}") from e
+            await asyncio.sleep(_backoff_delay(attempt, getattr(e, "retry_after", None)))
+
+
+@atexit.register
+def close():
+    """Closes the shared sessions, runs automatically at interpreter exit"""
+    global _session, _async_session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+    if _loop is not None and _async_session is not None and not _async_session.closed:
+        asyncio.run_coroutine_threadsafe(_async_session.close(), _loop).result(timeout=5)
+        _async_session = None
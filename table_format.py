@@ -0,0 +1,90 @@
+import pandas as pd
+from st_aggrid import AgGrid, GridOptionsBuilder, JsCode
+from st_aggrid.shared import GridUpdateMode
+
+# column formats, values stay numeric and are formatted by AgGrid in the browser
+TEXT = "text"
+CURRENCY = "currency"
+AMOUNT = "amount"
+PERCENT = "percent"
+
+_AFFIXES = {
+    CURRENCY: ("$", ""),
+    AMOUNT: ("", ""),
+    PERCENT: ("", "%"),
+}
+
+_VALUE_FORMATTER = """
+    function(params) {
+        if (params.value == null || isNaN(params.value)) {
+            return '';
+        }
+        return 'PREFIX' + Number(params.value).toLocaleString('en-US', {minimumFractionDigits: PRECISION, maximumFractionDigits: PRECISION}) + 'SUFFIX';
+    }
+"""
+
+
+def column(label: str, kind: str = TEXT, precision: int = 2) -> dict:
+    """Declares how one column is presented
+
+    Args:
+        label (str): Column header
+        kind (str): One of TEXT, CURRENCY, AMOUNT, PERCENT
+            (default is TEXT)
+        precision (int): Number of decimals shown for numeric kinds
+            (default is 2)
+
+    Returns:
+        dict: Column spec for configure_columns and display_table
+    """
+    return {"label": label, "kind": kind, "precision": precision}
+
+
+def _value_formatter(kind: str, precision: int) -> JsCode:
+    prefix, suffix = _AFFIXES[kind]
+    return JsCode(
+        _VALUE_FORMATTER.replace("PREFIX", prefix).replace("SUFFIX", suffix).replace("PRECISION", str(precision))
+    )
+
+
+def configure_columns(options: GridOptionsBuilder, column_specs: dict):
+    """Applies column specs to an AgGrid options builder
+
+    Args:
+        options (GridOptionsBuilder): Builder created from the DataFrame that will be displayed
+        column_specs (dict): {column name: spec returned by column()}
+    """
+    # column names like "market.inputToken.symbol" are flat keys, not nested paths
+    options.configure_grid_options(suppressFieldDotNotation=True)
+    for field, spec in column_specs.items():
+        if spec["kind"] == TEXT:
+            options.configure_column(field, header_name=spec["label"])
+        else:
+            options.configure_column(
+                field,
+                header_name=spec["label"],
+                type=["numericColumn"],
+                valueFormatter=_value_formatter(spec["kind"], spec["precision"]),
+            )
+
+
+def display_table(df: pd.DataFrame, column_specs: dict, key: str):
+    """Shows a read only AgGrid table with only the columns in column_specs
+
+    Args:
+        df (pd.DataFrame): Source dataframe, numeric columns are left numeric
+        column_specs (dict): {column name: spec returned by column()}, in display order
+        key (str): Unique Streamlit key of the table
+    """
+    df = df[list(column_specs)]
+    options = GridOptionsBuilder.from_dataframe(df)
+    configure_columns(options, column_specs)
+    AgGrid(
+        df,
+        gridOptions=options.build(),
+        theme="dark",
+        update_mode=GridUpdateMode.NO_UPDATE,
+        allow_unsafe_jscode=True,
+        fit_columns_on_grid_load=True,
+        key=key,
+    )
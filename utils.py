@@ -1,9 +1,10 @@
+import numpy as np
 import pandas as pd
-import requests
-from st_aggrid import AgGrid, GridOptionsBuilder
-from st_aggrid.shared import GridUpdateMode
+from decimal import Decimal
 import asyncio
-import aiohttp
+from collections import OrderedDict
+import instrumentation
+import subgraph
 
 
 def convert_address_to_link(address: str, url_root: str, target: str = "_blank") -> str:
@@ -21,6 +22,32 @@ def convert_address_to_link(address: str, url_root: str, target: str = "_blank")
     return f'<a target="{target}" href="{url_root}{address}">{address}</a>'
 
 
+def normalize_token_amounts(amounts: pd.Series, decimals: pd.Series, exact: bool = False) -> pd.Series:
+    """Converts raw on-chain integer amounts to token units in one vectorized pass
+
+    The decimal strings are parsed straight to float64 by numpy, which rounds correctly
+    for any length, and divided by exact powers of ten. This avoids creating a Python
+    int per row and stays within float tolerance of int(amount) / 10 ** decimals.
+
+    About 1.5x faster than .apply(int), not 10x, since every row is still a Python str.
+
+    Args:
+        amounts (pd.Series): Raw amounts as decimal strings (BigInt fields from the subgraph)
+        decimals (pd.Series): Token decimals aligned with amounts
+        exact (bool): Return exact decimal.Decimal values instead of floats, for reconciliation only
+            since it runs per row
+            (default is False)
+
+    Returns:
+        pd.Series: amounts / 10 ** decimals with the index of amounts
+    """
+    if exact:
+        values = [Decimal(str(amount)).scaleb(-int(decimal)) for amount, decimal in zip(amounts, decimals)]
+        return pd.Series(values, index=amounts.index, dtype=object)
+    scale = np.power(10.0, decimals.to_numpy(dtype=np.float64))
+    return pd.Series(amounts.to_numpy().astype(np.float64) / scale, index=amounts.index)
+
+
 def get_lastest_synced_block_number(subgraph_url: str) -> int:
     latest_block_query = """
         query {
@@ -31,12 +58,8 @@ def get_lastest_synced_block_number(subgraph_url: str) -> int:
             }
         }
     """
-    payload = {
-        "query": latest_block_query
-    }
-    resp = requests.post(subgraph_url, json=payload)
-    data = resp.json()
-    return data["data"]["_meta"]["block"]["number"]
+    data = subgraph.query(subgraph_url, latest_block_query)
+    return data["_meta"]["block"]["number"]
 
 
 def _get_daily_snapshot_blocks(subgraph_url: str, days_back: int) -> pd.DataFrame:
@@ -59,315 +82,766 @@ def _get_daily_snapshot_blocks(subgraph_url: str, days_back: int) -> pd.DataFram
         }
     """
 
-    payload = {
-        "query": query, 
-        "variables": {
-            "days_back": days_back
-        }
+    variables = {
+        "days_back": days_back
     }
 
-    resp = requests.post(subgraph_url, json=payload)
-    data = resp.json()
-    df = pd.json_normalize(data['data']['financialsDailySnapshots'])
+    data = subgraph.query(subgraph_url, query, variables)
+    df = pd.json_normalize(data['financialsDailySnapshots'])
     df['blockNumber'] = pd.to_numeric(df['blockNumber'])
+    df['timestamp'] = pd.to_numeric(df['timestamp'])
     df['date'] = pd.to_datetime(df['timestamp'], unit='s')
     return df
 
 
-async def _get_account_daily_position(session: aiohttp.ClientSession, subgraph_url: str, account_id: str, block: int) -> dict:
-    """Gets account's open positions for given block"""
-    
-    query = """
-            query($account_id: String, $block_num: Int){
-                accounts(
-                    where: {openPositionCount_gt: 0, id: $account_id}
-                    block: {number: $block_num}
-                ) {
-                    account_id: id
-                    positions(where: {hashClosed: null}) {
-                        balance
-                        side
-                        market {
-                            market_id: id
-                            inputTokenPriceUSD
-                            inputToken {
-                                decimals
-                                symbol
-                            }
-                        }
-                    }
+def get_latest_daily_snapshot_block(subgraph_url: str) -> int:
+    """Block number of the newest daily snapshot, daily position history only changes when it does"""
+    return int(_get_daily_snapshot_blocks(subgraph_url, 1)["blockNumber"].iloc[0])
+
+
+# number of (account, block) pairs packed into one request, a single account's history
+# fits in one request per HISTORY_CHUNK_SIZE blocks, many accounts get fewer blocks each
+HISTORY_CHUNK_SIZE = 30
+# graph-node caps `first`, and with it the number of accounts one id_in filter can return
+MAX_ACCOUNTS_PER_QUERY = 1000
+ACCOUNT_BLOCK_CACHE_SIZE = 50000
+
+_ACCOUNT_AT_BLOCK_FIELDS = """
+        account_id: id
+        positions(where: {hashClosed: null}) {
+            balance
+            side
+            market {
+                market_id: id
+                inputTokenPriceUSD
+                inputToken {
+                    decimals
+                    symbol
                 }
             }
-        """
-
-    payload = {
-        "query": query,
-        "variables": {
-            "account_id": account_id,
-            "block_num": block
         }
+"""
+
+# (subgraph_url, account_id, block) -> account dict at that block, None if it had no open positions.
+# past blocks never change, so entries are only evicted to bound memory
+_account_block_cache = OrderedDict()
+
+
+def _accounts_history_query(blocks: list) -> str:
+    """Packs one aliased accounts query per block into a single request"""
+    aliases = []
+    for block in blocks:
+        aliases.append(
+            f"b{block}: accounts(first: {MAX_ACCOUNTS_PER_QUERY}, where: {{openPositionCount_gt: 0, id_in: $account_ids}}, block: {{number: {block}}}) {{"
+            + _ACCOUNT_AT_BLOCK_FIELDS + "    }"
+        )
+    return "query($account_ids: [String!]){\n    " + "\n    ".join(aliases) + "\n}\n"
+
+
+async def _get_accounts_positions_at_blocks(subgraph_url: str, account_ids: list, blocks: list) -> dict:
+    """Gets the accounts' open positions for a chunk of blocks in one request"""
+    variables = {
+        "account_ids": account_ids
     }
+    data = await subgraph.async_query(subgraph_url, _accounts_history_query(blocks), variables)
+    results = {}
+    for block in blocks:
+        found = {account["account_id"]: account for account in data[f"b{block}"]}
+        for account_id in account_ids:
+            results[(account_id, block)] = found.get(account_id)
+    return results
+
+
+async def _run_accounts_daily_positions(subgraph_url: str, batches: list) -> dict:
+    """Gathers one request per (account_ids, blocks) batch"""
+    tasks = [_get_accounts_positions_at_blocks(subgraph_url=subgraph_url, account_ids=account_ids, blocks=blocks) for account_ids, blocks in batches]
+    results = {}
+    for batch_result in await asyncio.gather(*tasks):
+        results.update(batch_result)
+    return results
+
+
+def _history_batches(missing: dict, chunk_size: int) -> list:
+    """Splits {account_ids: blocks} into request sized (account_ids, blocks) batches"""
+    batches = []
+    for account_ids, blocks in missing.items():
+        for i in range(0, len(account_ids), MAX_ACCOUNTS_PER_QUERY):
+            batch_ids = list(account_ids[i:i + MAX_ACCOUNTS_PER_QUERY])
+            blocks_per_query = max(1, chunk_size // len(batch_ids))
+            for j in range(0, len(blocks), blocks_per_query):
+                batches.append((batch_ids, blocks[j:j + blocks_per_query]))
+    return batches
+
+
+def _get_accounts_positions_history(subgraph_url: str, account_ids: list, blocks: list, chunk_size: int = HISTORY_CHUNK_SIZE) -> list:
+    """Gets account dicts at every block, only requesting (account, block) pairs that are not cached yet"""
+    # blocks missing the same accounts, usually all of them, are requested together
+    missing = {}
+    for block in blocks:
+        missing_ids = tuple(account_id for account_id in account_ids if (subgraph_url, account_id, block) not in _account_block_cache)
+        if missing_ids:
+            missing.setdefault(missing_ids, []).append(block)
+    missing_count = sum(len(account_ids) * len(blocks) for account_ids, blocks in missing.items())
+    instrumentation.record_cache("account_blocks", hit=True, count=len(account_ids) * len(blocks) - missing_count)
+    instrumentation.record_cache("account_blocks", hit=False, count=missing_count)
+
+    if missing:
+        fetched = subgraph.run(_run_accounts_daily_positions(subgraph_url=subgraph_url, batches=_history_batches(missing, chunk_size)))
+        for (account_id, block), account in fetched.items():
+            _account_block_cache[(subgraph_url, account_id, block)] = account
+        while len(_account_block_cache) > ACCOUNT_BLOCK_CACHE_SIZE:
+            _account_block_cache.popitem(last=False)
+
+    account_list = []
+    for block in blocks:
+        for account_id in account_ids:
+            account = _account_block_cache.get((subgraph_url, account_id, block))
+            if account is not None:
+                account_list.append(dict(account, block_number=block))
+    return account_list
+
+
+def get_accounts_daily_positions(subgraph_url: str, account_ids: list, days_back: int, chunk_size: int = HISTORY_CHUNK_SIZE) -> pd.DataFrame:
+    """Gets daily deposit and borrow totals of many accounts, e.g. a whole leaderboard, in bulk
+
+    Accounts are filtered with id_in, so the cost is roughly one request per block
+    rather than one per account per block.
 
-    resp = await session.request('POST', url=subgraph_url, json=payload)
-    data = await resp.json()
-    data["data"]["accounts"][0]["block_number"] = block
-    return data["data"]["accounts"][0]
-
-
-async def _run_account_daily_positions(subgraph_url: str, account_id: str, days_back: int) -> pd.DataFrame:
-    """Gathers coroutines for getting daily account positions"""
-
-    snapshot_blocks_df = _get_daily_snapshot_blocks(subgraph_url, days_back)
-    async with aiohttp.ClientSession() as session:
-        tasks = []
-        for block in snapshot_blocks_df["blockNumber"]:
-            tasks.append(_get_account_daily_position(session=session, subgraph_url=subgraph_url, account_id=account_id, block=block))
-        account_daily_positions_list = await asyncio.gather(*tasks, return_exceptions=True)
-        return account_daily_positions_list, snapshot_blocks_df
-
-def get_account_daily_positions(subgraph_url: str, account_id: str, days_back: int):
-    """Runs daily account position queries asynchronously and formats resulting dataframe"""
-    account_daily_positions_list, snapshot_blocks_df = asyncio.run(_run_account_daily_positions(subgraph_url=subgraph_url, account_id=account_id, days_back=days_back))
-    print(account_daily_positions_list)
-    positions_df = pd.json_normalize(account_daily_positions_list, ["positions"], ["account_id", "block_number"])
-    positions_df["balance"] = positions_df["balance"].apply(int) # numbers too large for pd.to_numeric()
-    positions_df["market.inputTokenPriceUSD"] = pd.to_numeric(positions_df["market.inputTokenPriceUSD"])
-    positions_df["balance_adj"] = positions_df["balance"] / (10 ** positions_df["market.inputToken.decimals"])
-    positions_df["balance_usd"] = positions_df["balance_adj"] * positions_df["market.inputTokenPriceUSD"]
-    # don't need these anymore and balance will just cause issues due to large numbers
-    positions_df.drop(columns=["balance", "market.inputToken.decimals"], inplace=True)
+    Args:
+        subgraph_url (str): URL of extended lending subgraph
+        account_ids (list): Account addresses
+        days_back (int): Number of daily snapshots to include
+        chunk_size (int): Number of (account, block) pairs packed into one request
+            (default is HISTORY_CHUNK_SIZE)
 
-    lender_amounts_by_block = positions_df[(positions_df["side"] == "LENDER")].groupby(["block_number"], as_index=False)["balance_usd"].sum()
-    lender_amounts_by_block.rename(columns={"block_number": "blockNumber", "balance_usd": "deposits_usd"}, inplace=True)
-    if 'deposits_usd' not in lender_amounts_by_block.columns:
-        lender_amounts_by_block['deposits_usd'] = None
-    borrower_amounts_by_block = positions_df[(positions_df["side"] == "BORROWER")].groupby(["block_number"], as_index=False)["balance_usd"].sum()
-    borrower_amounts_by_block.rename(columns={"block_number": "blockNumber", "balance_usd": "borrows_usd"}, inplace=True)
-    if 'borrows_usd' not in borrower_amounts_by_block.columns:
-        borrower_amounts_by_block['borrows_usd'] = None
+    Returns:
+        pd.DataFrame: Long format Pandas DataFrame with one row per account and snapshot block and columns
+            ['account_id', 'blockNumber', 'timestamp', 'date', 'borrows_usd', 'deposits_usd']
+    """
+    account_ids = list(dict.fromkeys(account_ids))
+    with instrumentation.stage("daily_positions.fetch") as info:
+        snapshot_blocks_df = _get_daily_snapshot_blocks(subgraph_url, days_back)
+        blocks = [int(block) for block in snapshot_blocks_df["blockNumber"]]
+        account_daily_positions_list = _get_accounts_positions_history(subgraph_url=subgraph_url, account_ids=account_ids, blocks=blocks, chunk_size=chunk_size)
+        info["rows_out"] = len(account_daily_positions_list)
+
+    with instrumentation.stage("daily_positions.normalize", rows_in=len(account_daily_positions_list)) as info:
+        positions_df = pd.json_normalize(account_daily_positions_list, ["positions"], ["account_id", "block_number"])
+        positions_df = positions_df.reindex(columns=["balance", "side", "market.inputTokenPriceUSD", "market.inputToken.decimals", "account_id", "block_number"])
+        positions_df["market.inputTokenPriceUSD"] = pd.to_numeric(positions_df["market.inputTokenPriceUSD"])
+        positions_df["balance_adj"] = normalize_token_amounts(positions_df["balance"], positions_df["market.inputToken.decimals"])
+        positions_df["balance_usd"] = positions_df["balance_adj"] * positions_df["market.inputTokenPriceUSD"]
+        # don't need these anymore and balance will just cause issues due to large numbers
+        positions_df.drop(columns=["balance", "market.inputToken.decimals"], inplace=True)
+        info["rows_out"] = len(positions_df)
+
+    with instrumentation.stage("daily_positions.merge", rows_in=len(positions_df)) as info:
+        ts_accounts_positions_df = _daily_totals_by_block(snapshot_blocks_df, positions_df, account_ids)
+        info["rows_out"] = len(ts_accounts_positions_df)
+    return ts_accounts_positions_df
+
+
+def _daily_totals_by_block(snapshot_blocks_df: pd.DataFrame, positions_df: pd.DataFrame, account_ids: list) -> pd.DataFrame:
+    """Sums position USD values per account, block and side onto every (account, snapshot block) pair"""
+    totals_df = positions_df.pivot_table(index=["account_id", "block_number"], columns="side", values="balance_usd", aggfunc="sum")
+    totals_df = totals_df.reindex(columns=["BORROWER", "LENDER"]).rename(columns={"BORROWER": "borrows_usd", "LENDER": "deposits_usd"})
+    totals_df = totals_df.rename_axis(columns=None).reset_index().rename(columns={"block_number": "blockNumber"})
+
+    accounts_df = pd.DataFrame({"account_id": account_ids})
+    ts_accounts_positions_df = accounts_df.merge(snapshot_blocks_df, how="cross")
+    ts_accounts_positions_df = ts_accounts_positions_df.merge(totals_df, how="left", on=["account_id", "blockNumber"])
+    ts_accounts_positions_df[["borrows_usd", "deposits_usd"]] = ts_accounts_positions_df[["borrows_usd", "deposits_usd"]].fillna(0)
+    return ts_accounts_positions_df
+
+
+def get_account_daily_positions(subgraph_url: str, account_id: str, days_back: int, chunk_size: int = HISTORY_CHUNK_SIZE):
+    """Gets an account's daily deposit and borrow totals using batched, cached block queries
 
-    ts_account_positions_df = snapshot_blocks_df.merge(borrower_amounts_by_block, how="left", on="blockNumber")
-    ts_account_positions_df = ts_account_positions_df.merge(lender_amounts_by_block, how="left", on="blockNumber")
-    ts_account_positions_df.fillna(0, inplace=True)
-    return ts_account_positions_df
+    Args:
+        subgraph_url (str): URL of extended lending subgraph
+        account_id (str): Account address
+        days_back (int): Number of daily snapshots to include
+        chunk_size (int): Number of blocks packed into one request
+            (default is HISTORY_CHUNK_SIZE)
 
+    Returns:
+        pd.DataFrame: Pandas DataFrame with columns ['blockNumber', 'timestamp', 'date', 'borrows_usd', 'deposits_usd']
+    """
+    ts_account_positions_df = get_accounts_daily_positions(subgraph_url, [account_id], days_back, chunk_size=chunk_size)
+    return ts_account_positions_df.drop(columns=["account_id"])
 
-def _query_position_market_data(subgraph_url: str, block_num: int):
-    last_id = "0x0000000000000000000000000000000000000000"
-    data_list = []
-    first = 500
 
-    while True:
-        # add parameter to filter by account
-        all_positions_query = """
-            query($first: Int, $last_id: String, $block_num: Int){
-                accounts(first: $first, where: {openPositionCount_gt: 0, id_gt: $last_id}, orderBy: id, block: {number: $block_num}) {
-                    account_id: id
-                    positions(where: {hashClosed: null}) {
-                        balance
-                        side
-                        market {
-                            market_id: id
-                            inputTokenPriceUSD
-                            inputToken {
-                                symbol
-                                decimals
-                            }
-                            rates {
-                                rate
-                                rate_side: side
-                                rate_type: type
-                            }
-                            dailySnapshots(first: 1, orderBy: timestamp, orderDirection: desc) {
-                                totalBorrowBalanceUSD
-                                totalDepositBalanceUSD
-                            }
-                        }
-                    }
+ZERO_ADDRESS = "0x0000000000000000000000000000000000000000"
+
+POSITIONS_PAGE_SIZE = 500
+
+OPEN_POSITIONS_COLUMNS = [
+    'position_id', 'account_id', 'side', 'market.inputTokenPriceUSD', 'market.inputToken.symbol',
+    'market.market_id', 'balance_adj', 'balance_usd', 'totalBorrowBalanceUSD', 'totalDepositBalanceUSD',
+    'borrower_stable_rate', 'borrower_variable_rate', 'lender_variable_rate']
+
+# an account can hold several open positions under one (account, market, side) key, e.g. a
+# stable and a variable borrow of the same asset, so snapshots are patched by position id
+POSITION_PATCH_COLUMNS = ["position_id", "account_id", "market.market_id", "side", "balance_adj"]
+
+RATE_COLUMNS = ["borrower_stable_rate", "borrower_variable_rate", "lender_variable_rate"]
+
+_ALL_POSITIONS_QUERY = """
+    query($first: Int, $last_id: String, $block_num: Int UPPER_ID_VARIABLE){
+        accounts(first: $first, where: {openPositionCount_gt: 0, id_gt: $last_id UPPER_ID_FILTER}, orderBy: id, block: {number: $block_num}) {
+            account_id: id
+            positions(where: {hashClosed: null}) {
+                position_id: id
+                balance
+                side
+                market {
+                    market_id: id
                 }
             }
-            """
-
-        payload = {
-            "query": all_positions_query, 
-            "variables": {
-                "first": first,
-                "last_id": last_id,
-                "block_num": block_num
+        }
+    }
+"""
+
+
+def _all_positions_query(bounded: bool) -> str:
+    """Builds the paged accounts query, optionally capped with an `id_lt: $upper_id` filter"""
+    if bounded:
+        return _ALL_POSITIONS_QUERY.replace("UPPER_ID_VARIABLE", ", $upper_id: String").replace("UPPER_ID_FILTER", ", id_lt: $upper_id")
+    return _ALL_POSITIONS_QUERY.replace("UPPER_ID_VARIABLE", "").replace("UPPER_ID_FILTER", "")
+
+
+def _get_markets_df(subgraph_url: str, block_num: int) -> pd.DataFrame:
+    """Gets price, token, rate and latest daily totals of every market at a block
+
+    Args:
+        subgraph_url (str): URL of extended lending subgraph
+        block_num (int): block height to query
+
+    Returns:
+        pd.DataFrame: One row per market with columns
+            ['market.market_id', 'market.inputTokenPriceUSD', 'market.inputToken.symbol', 'market.inputToken.decimals',
+            'totalBorrowBalanceUSD', 'totalDepositBalanceUSD', 'borrower_stable_rate', 'borrower_variable_rate', 'lender_variable_rate']
+    """
+
+    query = """
+        query($block_num: Int){
+            markets(first: 1000, block: {number: $block_num}) {
+                market_id: id
+                inputTokenPriceUSD
+                inputToken {
+                    symbol
+                    decimals
+                }
+                rates {
+                    rate
+                    rate_side: side
+                    rate_type: type
+                }
+                dailySnapshots(first: 1, orderBy: timestamp, orderDirection: desc) {
+                    totalBorrowBalanceUSD
+                    totalDepositBalanceUSD
+                }
             }
         }
-        resp = requests.post(subgraph_url, json=payload)
-        data = resp.json()
-        data_list.extend(data["data"]["accounts"])
+    """
 
-        if (len(data["data"]["accounts"]) != first):
-            return data_list
+    variables = {
+        "block_num": block_num
+    }
+
+    data = subgraph.query(subgraph_url, query, variables)
+    markets = data["markets"]
+
+    markets_df = pd.json_normalize(markets)[["market_id", "inputTokenPriceUSD", "inputToken.symbol", "inputToken.decimals"]]
+    markets_df.columns = ["market.market_id", "market.inputTokenPriceUSD", "market.inputToken.symbol", "market.inputToken.decimals"]
+
+    snapshots_df = pd.json_normalize(markets, record_path=["dailySnapshots"], meta=["market_id"])
+    snapshots_df = snapshots_df.reindex(columns=["market_id", "totalBorrowBalanceUSD", "totalDepositBalanceUSD"])
+
+    rates_df = pd.json_normalize(markets, record_path=["rates"], meta=["market_id"])
+    rates_df = rates_df.reindex(columns=["market_id", "rate", "rate_side", "rate_type"])
+    rates_df["rate"] = pd.to_numeric(rates_df["rate"])
+    rates_df["rate_column"] = rates_df["rate_side"].str.lower() + "_" + rates_df["rate_type"].str.lower() + "_rate"
+    rates_flat_df = rates_df.pivot_table(index="market_id", columns="rate_column", values="rate", aggfunc="first").reindex(columns=RATE_COLUMNS)
+
+    markets_df = markets_df.merge(snapshots_df, how="left", left_on="market.market_id", right_on="market_id").drop(columns=["market_id"])
+    markets_df = markets_df.merge(rates_flat_df, how="left", left_on="market.market_id", right_index=True)
+    numeric_columns = ["market.inputTokenPriceUSD", "totalBorrowBalanceUSD", "totalDepositBalanceUSD"] + RATE_COLUMNS
+    markets_df[numeric_columns] = markets_df[numeric_columns].apply(pd.to_numeric)
+    return markets_df
+
+
+def _adjust_balances(positions_df: pd.DataFrame, markets_df: pd.DataFrame, exact: bool = False) -> pd.DataFrame:
+    """Converts raw position balances to token units using each market's decimals"""
+    positions_df = positions_df.merge(markets_df[["market.market_id", "market.inputToken.decimals"]], on="market.market_id")
+    positions_df["balance_adj"] = normalize_token_amounts(positions_df["balance"], positions_df["market.inputToken.decimals"])
+    if exact:
+        positions_df["balance_exact"] = normalize_token_amounts(positions_df["balance"], positions_df["market.inputToken.decimals"], exact=True)
+    # don't need these anymore and balance will just cause issues due to large numbers
+    return positions_df.drop(columns=["balance", "market.inputToken.decimals"])
+
+
+def _join_market_data(positions_df: pd.DataFrame, markets_df: pd.DataFrame) -> pd.DataFrame:
+    """Joins market attributes onto POSITION_PATCH_COLUMNS rows"""
+    results_df = positions_df.merge(markets_df.drop(columns=["market.inputToken.decimals"]), on="market.market_id")
+    results_df["balance_usd"] = results_df["balance_adj"] * results_df["market.inputTokenPriceUSD"]
+    if "balance_exact" in results_df.columns:
+        return results_df[OPEN_POSITIONS_COLUMNS + ["balance_exact"]]
+    return results_df[OPEN_POSITIONS_COLUMNS]
+
+
+def _account_id_ranges(partitions: int) -> list:
+    """Splits the hex account id space into contiguous ranges on id prefixes
+
+    Args:
+        partitions (int): Number of ranges to split the id space into
+
+    Returns:
+        list: (lower, upper) tuples in ascending order. Accounts in a range satisfy
+            lower < id < upper, the last range has no upper bound (None)
+    """
+    if partitions < 1:
+        raise ValueError("partitions must be at least 1")
+    width = 1
+    while 16 ** width < partitions:
+        width += 1
+    space = 16 ** width
+    prefixes = ["0x" + format(space * i // partitions, f"0{width}x") for i in range(partitions)]
+    # a bare prefix sorts before every address that starts with it, so id_gt on the prefix
+    # behaves as id_gte on the addresses. The first range starts where the sequential scan does.
+    lowers = [ZERO_ADDRESS] + prefixes[1:]
+    uppers = prefixes[1:] + [None]
+    return list(zip(lowers, uppers))
+
+
+class _PositionColumns:
+    """Columnar buffers a position scan appends each page to as it arrives
+
+    Pages are flattened straight into small per page arrays, so neither the nested
+    account dicts nor a normalized intermediate frame are kept for the whole scan.
+    """
+
+    def __init__(self, markets_df: pd.DataFrame, exact: bool = False):
+        self.markets_df = markets_df
+        self.exact = exact
+        self._market_codes = {market_id: code for code, market_id in enumerate(markets_df["market.market_id"])}
+        self._scales = np.power(10.0, markets_df["market.inputToken.decimals"].to_numpy(dtype=np.float64))
+        self._decimals = markets_df["market.inputToken.decimals"].tolist()
+        self.position_ids = []
+        self.account_ids = []
+        self.sides = []
+        self.market_chunks = []
+        self.balance_chunks = []
+        self.balances_exact = []
+
+    def __len__(self) -> int:
+        return len(self.account_ids)
+
+    def append_page(self, accounts: list):
+        market_codes = []
+        balances = []
+        for account in accounts:
+            account_id = account["account_id"]
+            for position in account["positions"]:
+                self.position_ids.append(position["position_id"])
+                self.account_ids.append(account_id)
+                self.sides.append(position["side"])
+                # -1 marks positions in markets missing from markets_df, dropped like the inner merge did
+                market_codes.append(self._market_codes.get(position["market"]["market_id"], -1))
+                balances.append(position["balance"])
+        market_codes = np.array(market_codes, dtype=np.int16)
+        self.market_chunks.append(market_codes)
+        # the same per string float parse as normalize_token_amounts, orjson hands balances over as str
+        self.balance_chunks.append(np.array(balances, dtype=object).astype(np.float64) / self._scales[market_codes])
+        if self.exact:
+            self.balances_exact.extend(
+                Decimal(balance).scaleb(-int(self._decimals[code])) if code >= 0 else None
+                for balance, code in zip(balances, market_codes))
+
+    def extend(self, other: "_PositionColumns"):
+        self.position_ids.extend(other.position_ids)
+        self.account_ids.extend(other.account_ids)
+        self.sides.extend(other.sides)
+        self.market_chunks.extend(other.market_chunks)
+        self.balance_chunks.extend(other.balance_chunks)
+        self.balances_exact.extend(other.balances_exact)
+
+    def to_frame(self) -> pd.DataFrame:
+        """Builds the get_all_open_positions frame once, taking market attributes by market code"""
+        market_codes = np.concatenate(self.market_chunks) if self.market_chunks else np.empty(0, dtype=np.int16)
+        balance_adj = np.concatenate(self.balance_chunks) if self.balance_chunks else np.empty(0)
+        known = market_codes >= 0
+        results_df = self.markets_df.drop(columns=["market.inputToken.decimals"]).take(market_codes[known]).reset_index(drop=True)
+        results_df["position_id"] = np.array(self.position_ids, dtype=object)[known]
+        results_df["account_id"] = np.array(self.account_ids, dtype=object)[known]
+        results_df["side"] = np.array(self.sides, dtype=object)[known]
+        results_df["balance_adj"] = balance_adj[known]
+        results_df["balance_usd"] = results_df["balance_adj"] * results_df["market.inputTokenPriceUSD"]
+        if self.exact:
+            results_df["balance_exact"] = np.array(self.balances_exact, dtype=object)[known]
+            return results_df[OPEN_POSITIONS_COLUMNS + ["balance_exact"]]
+        return results_df[OPEN_POSITIONS_COLUMNS]
+
+
+def _query_position_market_data(subgraph_url: str, block_num: int, columns: _PositionColumns) -> _PositionColumns:
+    last_id = ZERO_ADDRESS
+    first = POSITIONS_PAGE_SIZE
+    all_positions_query = _all_positions_query(bounded=False)
+
+    while True:
+        variables = {
+            "first": first,
+            "last_id": last_id,
+            "block_num": block_num
+        }
+        data = subgraph.query(subgraph_url, all_positions_query, variables)
+        columns.append_page(data["accounts"])
+
+        if (len(data["accounts"]) != first):
+            return columns
+
+        # accounts are ordered by id, so the last one is the cursor for the next page
+        last_id = data["accounts"][-1]["account_id"]
+
+
+async def _query_account_id_range(semaphore: asyncio.Semaphore, subgraph_url: str, block_num: int, lower: str, upper: str, columns: _PositionColumns) -> _PositionColumns:
+    """Pages through every account with open positions in one id range"""
+    last_id = lower
+    first = POSITIONS_PAGE_SIZE
+    all_positions_query = _all_positions_query(bounded=upper is not None)
+
+    while True:
+        variables = {
+            "first": first,
+            "last_id": last_id,
+            "block_num": block_num
+        }
+        if upper is not None:
+            variables["upper_id"] = upper
+        async with semaphore:
+            data = await subgraph.async_query(subgraph_url, all_positions_query, variables)
+        accounts = data["accounts"]
+        columns.append_page(accounts)
+
+        if (len(accounts) != first):
+            return columns
+
+        last_id = accounts[-1]["account_id"]
+
+
+async def _run_partitioned_position_market_data(subgraph_url: str, block_num: int, partitions: int, max_concurrency: int, markets_df: pd.DataFrame, exact: bool) -> list:
+    """Gathers one paging coroutine per account id range, each filling its own buffers"""
+    semaphore = asyncio.Semaphore(max_concurrency)
+    tasks = []
+    for lower, upper in _account_id_ranges(partitions):
+        columns = _PositionColumns(markets_df, exact=exact)
+        tasks.append(_query_account_id_range(semaphore=semaphore, subgraph_url=subgraph_url, block_num=block_num, lower=lower, upper=upper, columns=columns))
+    return await asyncio.gather(*tasks)
+
+
+def _query_position_market_data_partitioned(subgraph_url: str, block_num: int, columns: _PositionColumns, partitions: int = 16, max_concurrency: int = 8) -> _PositionColumns:
+    """Same result as _query_position_market_data, fetched as concurrent id range scans
+
+    Args:
+        subgraph_url (str): URL of extended lending subgraph
+        block_num (int): block height to query
+        columns (_PositionColumns): Buffers the ranges are appended to
+        partitions (int): Number of account id ranges scanned at the same time
+            (default is 16)
+        max_concurrency (int): Maximum number of requests in flight
+            (default is 8)
+
+    Returns:
+        _PositionColumns: columns holding positions ordered by account id, identical to the sequential scan
+    """
+    range_columns = subgraph.run(_run_partitioned_position_market_data(
+        subgraph_url=subgraph_url, block_num=block_num, partitions=partitions, max_concurrency=max_concurrency,
+        markets_df=columns.markets_df, exact=columns.exact))
+    # ranges are ascending and disjoint, and each range is paged in id order
+    for range_result in range_columns:
+        columns.extend(range_result)
+    return columns
 
-        # get into df to get max account_id
-        tmp_df = pd.json_normalize(data["data"]["accounts"], ["positions"], ["account_id"])
-        last_id = tmp_df["account_id"].max()
-        print("Progress: ", "{:.1%}".format(int(last_id[:5], 16) / 0xfff), end="\r", flush=True)
-        
 
-def get_all_open_positions(subgraph_url: str, block_num: int) -> pd.DataFrame:
+def get_all_open_positions(subgraph_url: str, block_num: int, partitions: int = None, max_concurrency: int = 8, exact_balances: bool = False) -> pd.DataFrame:
     """Gets all open positions from extended lending subgraph
 
+    Pages are flattened into columnar buffers as they arrive and the DataFrame is
+    built once at the end.
+
     Args:
         subgraph_url (str): URL of extended lending subgraph
         block_num (int): block height to query
+        partitions (int): Number of account id ranges to scan concurrently, None scans sequentially
+            (default is None)
+        max_concurrency (int): Maximum number of requests in flight for the concurrent scan
+            (default is 8)
+        exact_balances (bool): Also return balance_exact, the token balance as decimal.Decimal
+            (default is False)
 
     Returns:
         pd.DataFrame: Pandas DataFrame of positions with columns
-            ['account_id', 'side', 'market.inputTokenPriceUSD', 'market.inputToken.symbol', 
+            ['position_id', 'account_id', 'side', 'market.inputTokenPriceUSD', 'market.inputToken.symbol',
             'market.market_id', 'balance_adj', 'balance_usd', 'totalBorrowBalanceUSD', 'totalDepositBalanceUSD',
             'borrower_stable_rate', 'borrower_variable_rate', 'lender_variable_rate']
     """
 
-    data_list = _query_position_market_data(subgraph_url=subgraph_url, block_num=block_num)
-    
-    positions_df = pd.json_normalize(data_list, ["positions"], ["account_id"])
-    positions_df["balance"] = positions_df["balance"].apply(int) # numbers too large for pd.to_numeric()
-    positions_df["market.inputTokenPriceUSD"] = pd.to_numeric(positions_df["market.inputTokenPriceUSD"])
-    positions_df["balance_adj"] = positions_df["balance"] / (10 ** positions_df["market.inputToken.decimals"])
-    positions_df["balance_usd"] = positions_df["balance_adj"] * positions_df["market.inputTokenPriceUSD"]
-    # don't need these anymore and balance will just cause issues due to large numbers
-    positions_df.drop(columns=["balance", "market.inputToken.decimals", "market.rates", "market.dailySnapshots"], inplace=True)
-
-    snapshots_df = pd.json_normalize(data_list, record_path=["positions", "market", "dailySnapshots"], meta=[["positions", "market", "market_id"]])
-    snapshots_df = snapshots_df.drop_duplicates()
-
-    rates_df = pd.json_normalize(data_list, record_path=["positions", "market", "rates"], meta=[["positions", "market", "market_id"]])
-    rates_df = rates_df.drop_duplicates()
-    rates_pivot = rates_df.pivot(index='positions.market.market_id', columns=['rate_side', 'rate_type'], values='rate')
-    rates_data = {
-        'positions.market.market_id': rates_pivot.index, 
-        'borrower_stable_rate': rates_pivot["BORROWER"].reset_index()["STABLE"], 
-        'borrower_variable_rate': rates_pivot["BORROWER"].reset_index()["VARIABLE"], 
-        'lender_variable_rate': rates_pivot["LENDER"].reset_index()["VARIABLE"]}
-    rates_flat_df = pd.DataFrame(rates_data)
-    positions_markets_rates_df = positions_df.merge(snapshots_df, left_on="market.market_id", right_on="positions.market.market_id").merge(rates_flat_df, left_on="market.market_id", right_on="positions.market.market_id")
-    results_df = positions_markets_rates_df[[
-        'account_id', 'side', 'market.inputTokenPriceUSD', 'market.inputToken.symbol', 
-        'market.market_id', 'balance_adj', 'balance_usd', 'totalBorrowBalanceUSD', 'totalDepositBalanceUSD',
-        'borrower_stable_rate', 'borrower_variable_rate', 'lender_variable_rate']]
-    results_df[["borrower_stable_rate", "borrower_variable_rate", "lender_variable_rate", "totalBorrowBalanceUSD", "totalDepositBalanceUSD"]] = results_df[["borrower_stable_rate", "borrower_variable_rate", "lender_variable_rate", "totalBorrowBalanceUSD", "totalDepositBalanceUSD"]].copy().apply(pd.to_numeric)
+    with instrumentation.stage("open_positions.fetch") as info:
+        # positions only carry the market id, market attributes come from one query at the same block
+        markets_df = _get_markets_df(subgraph_url=subgraph_url, block_num=block_num)
+        columns = _PositionColumns(markets_df, exact=exact_balances)
+        if partitions:
+            _query_position_market_data_partitioned(subgraph_url=subgraph_url, block_num=block_num, columns=columns, partitions=partitions, max_concurrency=max_concurrency)
+        else:
+            _query_position_market_data(subgraph_url=subgraph_url, block_num=block_num, columns=columns)
+        info["rows_out"] = len(columns)
+
+    with instrumentation.stage("open_positions.merge", rows_in=len(columns)) as info:
+        results_df = columns.to_frame()
+        info["rows_out"] = len(results_df)
     return results_df
 
 
-def get_account_events(subgraph_url: str, account_id: str) -> pd.DataFrame:
+def _query_changed_positions(subgraph_url: str, from_block: int, block_num: int) -> list:
+    """Pages through every position created or modified at or after from_block, as of block_num"""
 
     query = """
-    query($account_id: String){
-    accounts(where: {id: $account_id}) {
-        account_id: id
-        borrows {
-        amount
-        amountUSD
-        asset {
-            symbol
-            decimals
-        }
-        timestamp
-        }
-        deposits {
-        amount
-        amountUSD
-        asset {
-            symbol
-            decimals
-        }
-        timestamp
-        }
-        liquidates {
-        amount
-        amountUSD
-        asset {
-            symbol
-            decimals
-        }
-        timestamp
-        }
-        liquidations {
-        amount
-        amountUSD
-        asset {
-            decimals
-            symbol
-        }
-        timestamp
-        }
-        repays {
-        amount
-        amountUSD
-        asset {
-            decimals
-            symbol
-        }
-        timestamp
+        query($first: Int, $last_id: String, $from_block: Int, $block_num: Int){
+            positions(first: $first, where: {_change_block: {number_gte: $from_block}, id_gt: $last_id}, orderBy: id, block: {number: $block_num}) {
+                position_id: id
+                balance
+                side
+                hashClosed
+                account {
+                    account_id: id
+                }
+                market {
+                    market_id: id
+                }
+            }
         }
-        withdraws {
-        amount
-        amountUSD
-        asset {
-            decimals
-            symbol
+    """
+
+    last_id = ""
+    data_list = []
+    first = POSITIONS_PAGE_SIZE
+
+    while True:
+        variables = {
+            "first": first,
+            "last_id": last_id,
+            "from_block": from_block,
+            "block_num": block_num
         }
-        timestamp
+        data = subgraph.query(subgraph_url, query, variables)
+        data_list.extend(data["positions"])
+
+        if (len(data["positions"]) != first):
+            return data_list
+
+        last_id = data["positions"][-1]["position_id"]
+
+
+def update_open_positions(subgraph_url: str, open_positions_df: pd.DataFrame, from_block: int, block_num: int) -> pd.DataFrame:
+    """Brings a get_all_open_positions snapshot forward by only fetching positions that changed
+
+    Positions modified since from_block replace the existing rows with the same position
+    id, closed ones are dropped. Market prices, rates and totals are refreshed for every
+    row so balance_usd matches a full scan at block_num.
+
+    Args:
+        subgraph_url (str): URL of extended lending subgraph
+        open_positions_df (pd.DataFrame): Snapshot returned by get_all_open_positions or update_open_positions,
+            must have the position_id column
+        from_block (int): block height open_positions_df was taken at
+        block_num (int): block height to bring the snapshot to
+
+    Returns:
+        pd.DataFrame: Pandas DataFrame with the same columns as get_all_open_positions, including
+            balance_exact if open_positions_df has it
+    """
+
+    with instrumentation.stage("open_positions.fetch_changed") as info:
+        changed_list = _query_changed_positions(subgraph_url=subgraph_url, from_block=from_block, block_num=block_num)
+        markets_df = _get_markets_df(subgraph_url=subgraph_url, block_num=block_num)
+        info["rows_out"] = len(changed_list)
+    # snapshots taken with exact_balances keep balance_exact, computed for the changed rows too
+    exact = "balance_exact" in open_positions_df.columns
+    patch_columns = POSITION_PATCH_COLUMNS + ["balance_exact"] if exact else POSITION_PATCH_COLUMNS
+    positions_df = open_positions_df[patch_columns]
+
+    if changed_list:
+        with instrumentation.stage("open_positions.normalize", rows_in=len(changed_list)) as info:
+            changed_df = pd.json_normalize(changed_list).rename(columns={"account.account_id": "account_id"})
+            is_changed = positions_df["position_id"].isin(changed_df["position_id"])
+
+            opened_df = _adjust_balances(changed_df[changed_df["hashClosed"].isna()], markets_df, exact=exact)
+
+            positions_df = pd.concat([positions_df[~is_changed], opened_df[patch_columns]], ignore_index=True)
+            # keep the account ordering of a full scan
+            positions_df = positions_df.sort_values("account_id", kind="stable", ignore_index=True)
+            info["rows_out"] = len(positions_df)
+
+    with instrumentation.stage("open_positions.merge", rows_in=len(positions_df)) as info:
+        results_df = _join_market_data(positions_df, markets_df)
+        info["rows_out"] = len(results_df)
+    return results_df
+
+
+EVENTS_PAGE_SIZE = 1000
+ACCOUNT_EVENTS_CACHE_SIZE = 1000
+
+# event label: (event collection, field linking the event to the account)
+ACCOUNT_EVENT_TYPES = {
+    "deposit": ("deposits", "account"),
+    "borrow": ("borrows", "account"),
+    "withdraw": ("withdraws", "account"),
+    "liquidate": ("liquidates", "liquidator"),
+    "liquidation": ("liquidates", "liquidatee"),
+    "repay": ("repays", "account"),
+}
+
+_ACCOUNT_EVENTS_QUERY = """
+    query($first: Int, $account_id: String, $timestamp: BigInt, $seen_ids: [ID!]){
+        events: EVENT_COLLECTION(
+            first: $first
+            orderBy: timestamp
+            orderDirection: asc
+            where: {ACCOUNT_FIELD: $account_id, timestamp_gte: $timestamp, id_not_in: $seen_ids}
+        ) {
+            id
+            amount
+            amountUSD
+            asset {
+                symbol
+                decimals
+            }
+            timestamp
         }
     }
-    }
+"""
+
+# (subgraph_url, account_id) -> raw event dicts fetched so far, oldest first per event type
+_account_events_cache = OrderedDict()
+
+
+def clear_account_caches():
+    """Empties the in process account block and event caches, the next calls fetch from the subgraph again"""
+    _account_block_cache.clear()
+    _account_events_cache.clear()
+
+
+async def _page_account_events(subgraph_url: str, account_id: str, event: str, since_timestamp: int, seen_ids: list) -> list:
+    """Pages through one event type by timestamp, starting at since_timestamp
+
+    Events sharing the cursor timestamp are excluded by id, so pages never repeat or
+    skip events even when many of them land in the same block.
     """
+    collection, account_field = ACCOUNT_EVENT_TYPES[event]
+    query = _ACCOUNT_EVENTS_QUERY.replace("EVENT_COLLECTION", collection).replace("ACCOUNT_FIELD", account_field)
+    cursor = since_timestamp
+    cursor_ids = list(seen_ids)
+    events = []
 
-    payload = {
-            "query": query,
-            "variables": {
-                "account_id": account_id
-            }
+    while True:
+        variables = {
+            "first": EVENTS_PAGE_SIZE,
+            "account_id": account_id,
+            "timestamp": str(cursor),
+            "seen_ids": cursor_ids
         }
+        data = await subgraph.async_query(subgraph_url, query, variables)
+        page = data["events"]
+        for event_data in page:
+            event_data["event"] = event
+        events.extend(page)
+
+        if (len(page) != EVENTS_PAGE_SIZE):
+            return events
+
+        last_timestamp = int(page[-1]["timestamp"])
+        if last_timestamp != cursor:
+            cursor = last_timestamp
+            cursor_ids = []
+        cursor_ids += [event_data["id"] for event_data in page if int(event_data["timestamp"]) == cursor]
+
+
+async def _run_account_events(subgraph_url: str, account_id: str, cached_events: list) -> list:
+    """Gathers one paging coroutine per event type, each resuming after its newest cached event"""
+    tasks = []
+    for event in ACCOUNT_EVENT_TYPES:
+        timestamps = [int(event_data["timestamp"]) for event_data in cached_events if event_data["event"] == event]
+        since_timestamp = max(timestamps, default=0)
+        seen_ids = [event_data["id"] for event_data in cached_events if event_data["event"] == event and int(event_data["timestamp"]) == since_timestamp]
+        tasks.append(_page_account_events(subgraph_url=subgraph_url, account_id=account_id, event=event, since_timestamp=since_timestamp, seen_ids=seen_ids))
+    new_events = []
+    for event_list in await asyncio.gather(*tasks):
+        new_events.extend(event_list)
+    return new_events
 
-    resp = requests.post(subgraph_url, json=payload)
-    # print("Progress: Day", index, "of",  days_back, end="\r", flush=True)
-    data = resp.json()
-
-    deposits_df = pd.json_normalize(data["data"]["accounts"][0], ["deposits"])
-    deposits_df["event"] = "deposit"
-    borrows_df = pd.json_normalize(data["data"]["accounts"][0], ["borrows"])
-    borrows_df["event"] = "borrow"
-    withdraws_df = pd.json_normalize(data["data"]["accounts"][0], ["withdraws"])
-    withdraws_df["event"] = "withdraw"
-    liquidates_df = pd.json_normalize(data["data"]["accounts"][0], ["liquidates"])
-    liquidates_df["event"] = "liquidate"
-    liquidations_df = pd.json_normalize(data["data"]["accounts"][0], ["liquidations"])
-    liquidations_df["event"] = "liquidation"
-    repays_df = pd.json_normalize(data["data"]["accounts"][0], ["repays"])
-    repays_df["event"] = "repay"
-
-    events_df = pd.concat([deposits_df, borrows_df, withdraws_df, liquidates_df, liquidations_df, repays_df], ignore_index=True).sort_values("timestamp", ascending=False)
-    events_df['date'] = pd.to_datetime(events_df['timestamp'], unit='s')
-    events_df = events_df.set_index("date")
-
-    events_df["amountUSD"] = pd.to_numeric(events_df["amountUSD"])
-    events_df["amount"] = events_df["amount"].apply(int) # numbers too large for pd.to_numeric()
-    events_df["amount_adj"] = events_df["amount"] / (10 ** events_df["asset.decimals"])
-    # don't need these anymore and balance will just cause issues due to large numbers
-    events_df.drop(columns=["timestamp", "asset.decimals", "amount"], inplace=True)
-    events_df = events_df[['event', 'asset.symbol', 'amount_adj', 'amountUSD']]
+
+def get_account_events(subgraph_url: str, account_id: str) -> pd.DataFrame:
+    """Gets an account's complete deposit, borrow, withdraw, repay and liquidation history
+
+    Each event type is paged concurrently. Events already fetched for the account are
+    cached in process, so later calls only request events newer than the cached ones.
+
+    Args:
+        subgraph_url (str): URL of extended lending subgraph
+        account_id (str): Account address
+
+    Returns:
+        pd.DataFrame: Pandas DataFrame indexed by date, newest first, with columns
+            ['event', 'asset.symbol', 'amount_adj', 'amountUSD']
+    """
+    cache_key = (subgraph_url, account_id)
+    instrumentation.record_cache("account_events", hit=cache_key in _account_events_cache)
+    cached_events = _account_events_cache.pop(cache_key, [])
+    with instrumentation.stage("account_events.fetch") as info:
+        new_events = subgraph.run(_run_account_events(subgraph_url=subgraph_url, account_id=account_id, cached_events=cached_events))
+        info["rows_out"] = len(new_events)
+    account_events = cached_events + new_events
+    _account_events_cache[cache_key] = account_events
+    while len(_account_events_cache) > ACCOUNT_EVENTS_CACHE_SIZE:
+        _account_events_cache.popitem(last=False)
+
+    with instrumentation.stage("account_events.normalize", rows_in=len(account_events)) as info:
+        events_df = pd.json_normalize(account_events)
+        events_df = events_df.reindex(columns=["event", "amount", "amountUSD", "asset.symbol", "asset.decimals", "timestamp"])
+        events_df["timestamp"] = pd.to_numeric(events_df["timestamp"])
+        events_df = events_df.sort_values("timestamp", ascending=False)
+        events_df['date'] = pd.to_datetime(events_df['timestamp'], unit='s')
+        events_df = events_df.set_index("date")
+
+        events_df["amountUSD"] = pd.to_numeric(events_df["amountUSD"])
+        events_df["amount_adj"] = normalize_token_amounts(events_df["amount"], events_df["asset.decimals"])
+        events_df = events_df[['event', 'asset.symbol', 'amount_adj', 'amountUSD']]
+        info["rows_out"] = len(events_df)
 
     return events_df
 
 
-def aggrid_interactive_table(df: pd.DataFrame):
+def aggrid_interactive_table(df: pd.DataFrame, column_specs: dict = None):
     """Creates an st-aggrid interactive table based on a dataframe.
 
     Args:
         df (pd.DataFrame]): Source dataframe
+        column_specs (dict): {column name: table_format.column()} headers and formats
+            (default is None)
 
     Returns:
         dict: The selected row
     """
+    # imported here so the data functions (and worker.py) don't pull in streamlit
+    from st_aggrid import AgGrid, GridOptionsBuilder
+    from st_aggrid.shared import GridUpdateMode
+    import table_format
+
     options = GridOptionsBuilder.from_dataframe(
         df, enableRowGroup=True, enableValue=True, enablePivot=True
     )
+    if column_specs:
+        table_format.configure_columns(options, column_specs)
 
     options.configure_selection("single")
     selection = AgGrid(
@@ -0,0 +1,157 @@
+"""Builds open position snapshots outside of Streamlit and publishes them to the snapshot store
+
+Usage:
+    python worker.py [--subgraph-url URL ...] [--poll-seconds 300] [--full-resync-seconds 43200] [--once]
+        [--metrics-file worker.prom] [--log-metrics]
+
+The app reads the newest published snapshot when EXTERNAL_SNAPSHOT_WORKER is set in its secrets.
+--subgraph-url can be repeated, every deployment is polled concurrently and pinned to its own
+block. It defaults to the deployments in .streamlit/secrets.toml (see deployments.py).
+--metrics-file rewrites Prometheus counters after every poll, for node_exporter's textfile
+collector. --log-metrics prints every request, stage and cache event as a JSON line.
+"""
+import argparse
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import toml
+import utils
+import deployments
+import instrumentation
+import snapshot_store
+
+POLL_SECONDS = 300
+FULL_RESYNC_SECONDS = 43200
+SCAN_PARTITIONS = 16
+MAX_DEPLOYMENT_WORKERS = 8
+SECRETS_PATH = os.path.join(".streamlit", "secrets.toml")
+
+logger = logging.getLogger("whales.worker")
+
+
+def build_open_positions_snapshot(subgraph_url: str, previous: tuple = None, full_scan: bool = False, partitions: int = SCAN_PARTITIONS) -> tuple:
+    """Builds an open positions snapshot at the latest synced block
+
+    Args:
+        subgraph_url (str): URL of extended lending subgraph
+        previous (tuple): (block_num, pd.DataFrame) of the last snapshot, patched forward unless full_scan
+            (default is None)
+        full_scan (bool): Re-scan every account even if previous is given
+            (default is False)
+        partitions (int): Number of account id ranges scanned concurrently in a full scan
+            (default is SCAN_PARTITIONS)
+
+    Returns:
+        tuple: (block_num, pd.DataFrame), or None if previous is already at the latest block
+    """
+    block = utils.get_lastest_synced_block_number(subgraph_url)
+    # snapshots stored before position ids were kept can't be patched by id
+    if previous is None or full_scan or "position_id" not in previous[1].columns:
+        return block, utils.get_all_open_positions(subgraph_url, block, partitions=partitions)
+    previous_block, previous_df = previous
+    if block <= previous_block:
+        return None
+    return block, utils.update_open_positions(subgraph_url, previous_df, previous_block, block)
+
+
+def build_open_positions_snapshots(subgraph_urls: dict, previous: dict = None, full_scan: bool = False, partitions: int = SCAN_PARTITIONS) -> tuple:
+    """Builds open positions snapshots of several deployments concurrently
+
+    Every deployment is pinned to its own latest synced block. Requests of all deployments
+    share the subgraph client's background loop, with a separate in-flight budget per URL,
+    so the wall time is close to that of the slowest deployment alone.
+
+    Args:
+        subgraph_urls (dict): {deployment name: subgraph URL}
+        previous (dict): {deployment name: (block_num, pd.DataFrame)} of the last snapshots, deployments
+            without one are fully scanned
+            (default is None)
+        full_scan (bool): Re-scan every account of every deployment
+            (default is False)
+        partitions (int): Number of account id ranges scanned concurrently in a full scan, per deployment
+            (default is SCAN_PARTITIONS)
+
+    Returns:
+        tuple: ({deployment name: (block_num, pd.DataFrame) or None if already at the latest block},
+            {deployment name: exception} for deployments that failed)
+    """
+    previous = previous or {}
+    snapshots = {}
+    errors = {}
+    if not subgraph_urls:
+        return snapshots, errors
+    with ThreadPoolExecutor(max_workers=min(MAX_DEPLOYMENT_WORKERS, len(subgraph_urls)), thread_name_prefix="deployment") as pool:
+        futures = {
+            name: pool.submit(build_open_positions_snapshot, subgraph_url, previous.get(name), full_scan, partitions)
+            for name, subgraph_url in subgraph_urls.items()
+        }
+        for name, future in futures.items():
+            try:
+                snapshots[name] = future.result()
+            except Exception as e:
+                errors[name] = e
+    return snapshots, errors
+
+
+def run(subgraph_urls: dict, poll_seconds: int = POLL_SECONDS, full_resync_seconds: int = FULL_RESYNC_SECONDS, once: bool = False, metrics_file: str = None):
+    """Polls every deployment's subgraph and publishes a snapshot whenever one has advanced
+
+    Starts from the newest published snapshots if there are any. Failed refreshes are
+    logged and retried on the next poll so the last good snapshot stays published.
+    """
+    previous = deployments.load_latest_snapshots(subgraph_urls)
+    full_scanned_at = {name: time.time() for name in previous}
+
+    while True:
+        started = time.time()
+        # deployments due for a full resync are passed without a previous snapshot
+        patchable = {name: snapshot for name, snapshot in previous.items() if started - full_scanned_at.get(name, 0) <= full_resync_seconds}
+        snapshots, errors = build_open_positions_snapshots(subgraph_urls, patchable)
+        for name, error in errors.items():
+            logger.error("Snapshot refresh failed for %s", name, exc_info=error)
+        for name, snapshot in snapshots.items():
+            if name not in patchable:
+                full_scanned_at[name] = started
+            if snapshot is not None:
+                block, df = snapshot
+                path = snapshot_store.save_snapshot(subgraph_urls[name], snapshot_store.OPEN_POSITIONS, block, df)
+                logger.info("Published %s block %s (%s positions) to %s in %.1fs", name, block, len(df), path, time.time() - started)
+                previous[name] = snapshot
+        if metrics_file:
+            instrumentation.write_prometheus(metrics_file)
+
+        if once:
+            return
+        time.sleep(max(0, poll_seconds - (time.time() - started)))
+
+
+def _default_deployments() -> dict:
+    if os.environ.get("AAVE_SUBGRAPH"):
+        return {deployments.DEFAULT_DEPLOYMENT: os.environ["AAVE_SUBGRAPH"]}
+    if os.path.exists(SECRETS_PATH):
+        return deployments.get_deployments(toml.load(SECRETS_PATH))
+    return {}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Publish open position snapshots for the Whale Watcher app")
+    parser.add_argument("--subgraph-url", action="append", help="repeat for several deployments, defaults to $AAVE_SUBGRAPH or .streamlit/secrets.toml")
+    parser.add_argument("--poll-seconds", type=int, default=POLL_SECONDS)
+    parser.add_argument("--full-resync-seconds", type=int, default=FULL_RESYNC_SECONDS)
+    parser.add_argument("--once", action="store_true", help="publish one snapshot and exit")
+    parser.add_argument("--metrics-file", help="write Prometheus counters to this path after every poll")
+    parser.add_argument("--log-metrics", action="store_true", help="log instrumentation events as JSON lines")
+    args = parser.parse_args()
+    subgraph_urls = {url: url for url in args.subgraph_url} if args.subgraph_url else _default_deployments()
+    if not subgraph_urls:
+        parser.error("no subgraph URL, pass --subgraph-url or set AAVE_SUBGRAPH")
+    logging.basicConfig(format="%(asctime)s %(levelname)s %(message)s")
+    logger.setLevel(logging.INFO)
+    if args.log_metrics:
+        instrumentation.enable_logging()
+    run(subgraph_urls, poll_seconds=args.poll_seconds, full_resync_seconds=args.full_resync_seconds, once=args.once, metrics_file=args.metrics_file)
+
+
+if __name__ == "__main__":
+    main()